@@ -0,0 +1,95 @@
+"""
+Asyncio variant of the Up client surface; i.e. `list_accounts`, `Account` & `AllSpendingAccounts`.
+
+Each client takes an `AsyncSession`, so that Up paging can overlap with Woolies paging & receipt downloads in one event
+loop. See `woolies.aio` for the Woolies counterpart.
+"""
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Literal
+from urllib.parse import urljoin
+
+import up
+from utils import AsyncSession
+
+
+def new_async_session() -> AsyncSession:
+    """ Returns AsyncSession with Up authorisation headers """
+    return AsyncSession(headers=up.get_session().headers)
+
+
+async def list_accounts(session: AsyncSession) -> List[Dict[str, Any]]:
+    return (await session.get(url=urljoin(up.endpoint, 'accounts')))['data']
+
+
+class Account:
+    """ Base account class; create with `await Account.create(...)` """
+
+    def __init__(self, session: AsyncSession, account: Dict[str, Any]):
+        self.session = session
+        self.account = account
+        self.transaction_url = account['relationships']['transactions']['links']['related']
+
+    @classmethod
+    async def create(cls, session: AsyncSession, *,
+                     display_name: str,
+                     account_type: Literal['TRANSACTIONAL', 'SAVER'] = None,
+                     ownership_type: Literal['INDIVIDUAL', 'JOINT'] = None) -> 'Account':
+        registry = up.get_account_registry()
+        if (accounts := registry.cached()) is None:
+            accounts = registry.store(await list_accounts(session))
+        account = up.find_account(accounts,
+                                  display_name=display_name,
+                                  account_type=account_type,
+                                  ownership_type=ownership_type)
+        return cls(session, account)
+
+    async def get_transactions(self,
+                               page_size: int = up.DEFAULT_PAGE_SIZE,
+                               since: datetime = None,
+                               until: datetime = None,
+                               category: str = None) -> AsyncGenerator[List[up.Transaction], None]:
+        """ Yields list of transactions based off input filters """
+        response = await self.session.get(url=self.transaction_url,
+                                          params=up.transaction_params(page_size, since, until, category))
+        yield up.Transaction.from_page(response['data'])
+
+        # Continue with pagination link
+        while (url := response['links']['next']) is not None:
+            response = await self.session.get(url=url)
+            yield up.Transaction.from_page(response['data'])
+
+
+class AllSpendingAccounts:
+    """ Class for managing multiple transactional accounts; create with `await AllSpendingAccounts.create(...)` """
+
+    def __init__(self, session: AsyncSession, accounts: List[Dict[str, Any]]):
+        self.session = session
+        self._accounts = [account for account in accounts
+                          if account['attributes']['accountType'] == 'TRANSACTIONAL']
+        self._account_ids = {account['id'] for account in self._accounts}
+
+    @classmethod
+    async def create(cls, session: AsyncSession) -> 'AllSpendingAccounts':
+        """ Creates accounts view from the shared account registry when fresh; otherwise requests accounts """
+        registry = up.get_account_registry()
+        if (accounts := registry.cached()) is None:
+            accounts = registry.store(await list_accounts(session))
+        return cls(session, accounts)
+
+    async def get_transactions(self,
+                               page_size: int = up.DEFAULT_PAGE_SIZE,
+                               since: datetime = None,
+                               until: datetime = None,
+                               category: str = None) -> AsyncGenerator[List[up.Transaction], None]:
+        """ Yields list of transactions based off input filters; see `up.AllSpendingAccounts.get_transactions` """
+        if len(self._accounts) == 1:
+            url = self._accounts[0]['relationships']['transactions']['links']['related']
+        else:
+            url = urljoin(up.endpoint, 'transactions')
+        response = await self.session.get(url=url, params=up.transaction_params(page_size, since, until, category))
+        yield up.Transaction.from_page(response['data'], account_ids=self._account_ids)
+
+        # Continue with pagination link
+        while (url := response['links']['next']) is not None:
+            response = await self.session.get(url=url)
+            yield up.Transaction.from_page(response['data'], account_ids=self._account_ids)
@@ -0,0 +1,161 @@
+"""
+Vectorised spend analytics over receipt line items; requires `numpy`.
+
+Line items are loaded once into columnar arrays with interned description & store codes, so that group-bys, rolling
+aggregates & unit prices run as array operations rather than Python loops over `ReceiptDetails.items`.
+
+    >>> items = LineItems.from_rows(export.iter_rows(reconciliation.matched))
+    >>> items.price_history('WW Whole Milk 2L')
+"""
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+Row = Dict[str, Any]
+
+
+class LineItems:
+    """ Columnar receipt line items; amounts in integer cents & weights in integer grams (0 when not weighed) """
+
+    def __init__(self,
+                 dates: np.ndarray,
+                 description_codes: np.ndarray,
+                 descriptions: List[str],
+                 store_codes: np.ndarray,
+                 stores: List[str],
+                 amounts: np.ndarray,
+                 quantities: np.ndarray,
+                 weights: np.ndarray):
+        self.dates = dates  # datetime64[s], UTC
+        self.description_codes = description_codes
+        self.descriptions = np.array(descriptions, dtype=object)
+        self.store_codes = store_codes
+        self.stores = np.array(stores, dtype=object)
+        self.amounts = amounts
+        self.quantities = quantities
+        self.weights = weights
+        self._description_index = {description: code for code, description in enumerate(descriptions)}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Row]) -> 'LineItems':
+        """ Returns line items from rows, as per `export.iter_rows` or an exported file's records """
+        descriptions: Dict[str, int] = {}
+        stores: Dict[str, int] = {}
+        dates, description_codes, store_codes, amounts, quantities, weights = [], [], [], [], [], []
+        for row in rows:
+            dates.append(np.datetime64(_utc_naive(row['date']), 's'))
+            description_codes.append(descriptions.setdefault(row['description'], len(descriptions)))
+            store_codes.append(stores.setdefault(row['origin'], len(stores)))
+            amounts.append(int(_decimal(row['amount']) * 100))
+            quantities.append(int(row['quantity'] or 0))
+            weights.append(int(weight * 1000) if (weight := _decimal(row['weight'])) is not None else 0)
+
+        return cls(dates=np.array(dates, dtype='datetime64[s]'),
+                   description_codes=np.array(description_codes, dtype=np.int32),
+                   descriptions=list(descriptions),
+                   store_codes=np.array(store_codes, dtype=np.int32),
+                   stores=list(stores),
+                   amounts=np.array(amounts, dtype=np.int64),
+                   quantities=np.array(quantities, dtype=np.int32),
+                   weights=np.array(weights, dtype=np.int64))
+
+    def code(self, description: str) -> int:
+        """ Returns interned code of description """
+        try:
+            return self._description_index[description]
+        except KeyError:
+            raise KeyError(f"no purchases of {description!r}") from None
+
+    @property
+    def unit_prices(self) -> np.ndarray:
+        """ Dollars per unit, or per kg for weighed goods """
+        unit_prices = np.full(len(self), np.nan)
+        is_weighed = self.weights > 0
+        is_counted = ~is_weighed & (self.quantities > 0)
+        unit_prices[is_weighed] = self.amounts[is_weighed] / self.weights[is_weighed] * 10  # cents/g to $/kg
+        unit_prices[is_counted] = self.amounts[is_counted] / self.quantities[is_counted] / 100
+        return unit_prices
+
+    def spend_by_item_month(self) -> Dict[str, np.ndarray]:
+        """ Returns total spend in dollars grouped by month & description """
+        months = self.dates.astype('datetime64[M]')
+        unique_months, month_codes = np.unique(months, return_inverse=True)
+        keys = month_codes.astype(np.int64) * len(self.descriptions) + self.description_codes
+        unique_keys, key_codes = np.unique(keys, return_inverse=True)
+        spend = np.bincount(key_codes, weights=self.amounts) / 100
+        return {
+            'month': unique_months[unique_keys // len(self.descriptions)],
+            'description': self.descriptions[unique_keys % len(self.descriptions)],
+            'spend': spend,
+        }
+
+    def spend_by_month(self) -> Dict[str, np.ndarray]:
+        """ Returns total spend in dollars grouped by month """
+        unique_months, month_codes = np.unique(self.dates.astype('datetime64[M]'), return_inverse=True)
+        return {'month': unique_months, 'spend': np.bincount(month_codes, weights=self.amounts) / 100}
+
+    def price_history(self, description: str, store: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """ Returns date-ordered unit prices of description across stores, or at a single store """
+        mask = self.description_codes == self.code(description)
+        if store is not None:
+            mask &= self.stores[self.store_codes] == store
+        order = np.argsort(self.dates[mask], kind='stable')
+        return {
+            'date': self.dates[mask][order],
+            'store': self.stores[self.store_codes[mask]][order],
+            'unit_price': self.unit_prices[mask][order],
+        }
+
+    def price_per_kg(self) -> Dict[str, np.ndarray]:
+        """ Returns mean, min & max price per kg of each weighed good """
+        is_weighed = self.weights > 0
+        codes = self.description_codes[is_weighed]
+        prices = self.unit_prices[is_weighed]
+        unique_codes, key_codes = np.unique(codes, return_inverse=True)
+        minima = np.full(len(unique_codes), np.inf)
+        maxima = np.full(len(unique_codes), -np.inf)
+        np.minimum.at(minima, key_codes, prices)
+        np.maximum.at(maxima, key_codes, prices)
+        return {
+            'description': self.descriptions[unique_codes],
+            'mean': np.bincount(key_codes, weights=prices) / np.bincount(key_codes),
+            'min': minima,
+            'max': maxima,
+        }
+
+    def rolling_spend(self, window_days: int = 30) -> Dict[str, np.ndarray]:
+        """ Returns daily spend in dollars & its trailing rolling sum over window_days """
+        if window_days < 1:
+            raise ValueError(f"window_days must be at least 1, not {window_days}")
+        days = self.dates.astype('datetime64[D]')
+        first_day = days.min()
+        day_codes = (days - first_day).astype(np.int64)
+        daily = np.bincount(day_codes, weights=self.amounts) / 100
+        cumulative = np.concatenate(([0.], np.cumsum(daily)))
+        lagged = np.concatenate((np.zeros(window_days), cumulative[:-window_days]))[:len(cumulative)]
+        return {
+            'day': first_day + np.arange(len(daily)),
+            'spend': daily,
+            'rolling_spend': (cumulative - lagged)[1:],
+        }
+
+
+def _decimal(value: Any) -> Optional[Decimal]:
+    # Exported amounts are Decimals, numbers or, in CSV, strings; where an empty string is None
+    if value is None or value == '':
+        return None
+    return Decimal(str(value))
+
+
+def _utc_naive(date: Any) -> datetime:
+    # numpy.datetime64 has no time zones; normalise to naive UTC
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
@@ -0,0 +1,286 @@
+"""
+Append-only archive of raw Woolies responses; i.e. activity-feed items & e-receipt `data` payloads, kept past Woolies'
+retention without a file per receipt or holding `Transaction.raw` in memory.
+
+An archive is a directory of two files:
+
+- `blocks`: compressed blocks of JSON records, each block prefixed by its codec & compressed length. Blocks are zstd
+  compressed if `zstandard` is installed, otherwise zlib; either is read back whichever wrote it.
+- `index`: fixed-width entries of (key digest, kind, block offset, record offset, record length) per record; keyed by
+  transaction id for feed items & `receiptKey` for receipts.
+
+Both files are memory-mapped. The index is loaded into a dict on open, so a lookup costs one dict access & the
+decompression of one block, while scans stream block by block. Records are only ever appended; data is written before
+its index entries, so an interrupted write never leaves an entry pointing at a missing block.
+
+    >>> with Archive('archive/') as archive:
+    ...     archive.add_receipt(receipt_key, woolies.ReceiptDetails.get_raw_receipt(receipt_key))
+    ...     receipt = woolies.ReceiptDetails.from_archive(archive, receipt_key)
+
+    $ python archive.py archive/ feed  # every field of the whole activity feed
+    $ python archive.py archive/ import up_woolies.sqlite3  # a store's raw receipts
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Literal, Tuple
+
+BLOCKS_NAME = 'blocks'
+INDEX_NAME = 'index'
+
+DEFAULT_BLOCK_SIZE = 256 * 1024  # uncompressed bytes per block
+DEFAULT_CACHED_BLOCKS = 8  # decompressed blocks kept for repeat lookups
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+KIND_FEED_ITEM = 0
+KIND_RECEIPT = 1
+KINDS = {'feed_item': KIND_FEED_ITEM, 'receipt': KIND_RECEIPT}
+
+_BLOCK_HEADER = struct.Struct('<BI')  # codec, compressed length
+_INDEX_ENTRY = struct.Struct('<16sBQII')  # key digest, kind, block offset, record offset, record length
+
+Kind = Literal['feed_item', 'receipt']
+Record = Dict[str, Any]
+
+
+def key_digest(kind: Kind, key: str) -> bytes:
+    return hashlib.blake2b(f'{kind}:{key}'.encode(), digest_size=16).digest()
+
+
+def _compress(data: bytes) -> Tuple[int, bytes]:
+    try:
+        import zstandard
+    except ImportError:
+        return CODEC_ZLIB, zlib.compress(data, 6)
+    return CODEC_ZSTD, zstandard.ZstdCompressor(level=10).compress(data)
+
+
+def _decompress(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_ZSTD:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is required to read zstd-compressed archive blocks") from None
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"unknown archive block codec {codec}")
+
+
+class Archive:
+    """
+    Append-only, compressed & memory-mapped archive of raw feed items & receipts; thread-safe.
+
+    Added records are buffered into a block until it reaches `block_size`, or `flush()`/`close()`. A record that's
+    already archived, or buffered, is not added again; raw responses never change once issued.
+    """
+
+    def __init__(self, directory: str, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.block_size = block_size
+        self._blocks_file = open(self.directory / BLOCKS_NAME, 'ab+')
+        self._index_file = open(self.directory / INDEX_NAME, 'ab+')
+        self._blocks_view = None
+        self._index: Dict[bytes, Tuple[int, int, int, int]] = {}  # digest -> kind, block offset, offset, length
+        self._pending: List[Tuple[bytes, int, bytes]] = []  # digest, kind, encoded record
+        self._pending_digests = set()
+        self._pending_size = 0
+        self._cache: OrderedDict[int, bytes] = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index) + len(self._pending)
+
+    def __contains__(self, item: Tuple[Kind, str]) -> bool:
+        kind, key = item
+        digest = key_digest(kind, key)
+        with self._lock:
+            return digest in self._index or digest in self._pending_digests
+
+    # Writing
+
+    def add_receipt(self, receipt_key: str, data: Dict[str, Any]) -> bool:
+        """ Adds e-receipt `data` payload; as per `ReceiptDetails.get_raw_receipt`. Returns whether it was new """
+        return self._add('receipt', receipt_key, {'receiptKey': receipt_key, 'data': data})
+
+    def add_feed_item(self, item: Dict[str, Any], group_title: str) -> bool:
+        """ Adds activity-feed item with the title of its group, as needed by `Transaction.from_response` """
+        return self._add('feed_item', item['id'], {'title': group_title, 'item': item})
+
+    def add_feed_page(self, data: Dict[str, Any]) -> int:
+        """ Adds each item of an activity-feed page; as per `Transaction.list_raw_pages`. Returns the number new """
+        return sum(self.add_feed_item(item, group['title'])
+                   for group in data['rtlRewardsActivityFeed']['list']['groups']
+                   for item in group['items'])
+
+    def _add(self, kind: Kind, key: str, record: Record) -> bool:
+        digest = key_digest(kind, key)
+        encoded = json.dumps(record, separators=(',', ':')).encode()
+        with self._lock:
+            if digest in self._index or digest in self._pending_digests:
+                return False
+            self._pending.append((digest, KINDS[kind], encoded))
+            self._pending_digests.add(digest)
+            self._pending_size += len(encoded)
+            if self._pending_size >= self.block_size:
+                self.flush()
+            return True
+
+    def flush(self):
+        """ Writes buffered records as a block, then their index entries """
+        with self._lock:
+            if not self._pending:
+                return
+            codec, compressed = _compress(b''.join(encoded for _, _, encoded in self._pending))
+            self._blocks_file.seek(0, 2)
+            block_offset = self._blocks_file.tell()
+            self._blocks_file.write(_BLOCK_HEADER.pack(codec, len(compressed)) + compressed)
+            self._blocks_file.flush()
+
+            entries, offset = [], 0
+            for digest, kind, encoded in self._pending:
+                entries.append(_INDEX_ENTRY.pack(digest, kind, block_offset, offset, len(encoded)))
+                self._index[digest] = (kind, block_offset, offset, len(encoded))
+                offset += len(encoded)
+            self._index_file.write(b''.join(entries))
+            self._index_file.flush()
+            self._pending, self._pending_digests, self._pending_size = [], set(), 0
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._blocks_view is not None:
+                self._blocks_view.close()
+                self._blocks_view = None
+            self._blocks_file.close()
+            self._index_file.close()
+
+    # Reading
+
+    def receipt(self, receipt_key: str) -> Dict[str, Any]:
+        """ Returns e-receipt `data` payload; raises KeyError if not archived """
+        return self.get('receipt', receipt_key)['data']
+
+    def feed_item(self, transaction_id: str) -> Tuple[Dict[str, Any], str]:
+        """ Returns activity-feed item & the title of its group; raises KeyError if not archived """
+        record = self.get('feed_item', transaction_id)
+        return record['item'], record['title']
+
+    def get(self, kind: Kind, key: str) -> Record:
+        digest = key_digest(kind, key)
+        with self._lock:
+            if digest in self._pending_digests:
+                self.flush()
+            _, block_offset, offset, length = self._index[digest]
+            block = self._block(block_offset)
+        return json.loads(block[offset:offset + length])
+
+    def scan(self, kind: Kind = None) -> Iterator[Record]:
+        """ Yields archived records, optionally of one kind, in the order added; one block decompressed at a time """
+        self.flush()
+        with self._lock:
+            entries = sorted((block_offset, offset, length)
+                             for entry_kind, block_offset, offset, length in self._index.values()
+                             if kind is None or entry_kind == KINDS[kind])
+        block_offset, block = None, b''
+        for entry_block_offset, offset, length in entries:
+            if entry_block_offset != block_offset:
+                block_offset = entry_block_offset
+                with self._lock:
+                    block = self._read_block(block_offset)  # bypass the cache; scans would only churn it
+            yield json.loads(block[offset:offset + length])
+
+    def _block(self, block_offset: int) -> bytes:
+        if (block := self._cache.get(block_offset)) is not None:
+            self._cache.move_to_end(block_offset)
+            return block
+        block = self._cache[block_offset] = self._read_block(block_offset)
+        if len(self._cache) > DEFAULT_CACHED_BLOCKS:
+            self._cache.popitem(last=False)
+        return block
+
+    def _read_block(self, block_offset: int) -> bytes:
+        view = self._view()
+        codec, length = _BLOCK_HEADER.unpack_from(view, block_offset)
+        start = block_offset + _BLOCK_HEADER.size
+        return _decompress(codec, view[start:start + length])
+
+    def _view(self) -> mmap.mmap:
+        # (Re)maps the blocks file once it has grown past the current mapping
+        size = self._blocks_file.seek(0, 2)
+        if self._blocks_view is None or len(self._blocks_view) < size:
+            if self._blocks_view is not None:
+                self._blocks_view.close()
+            self._blocks_view = mmap.mmap(self._blocks_file.fileno(), size, access=mmap.ACCESS_READ)
+        return self._blocks_view
+
+    def _load_index(self):
+        size = self._index_file.seek(0, 2)
+        if size % _INDEX_ENTRY.size:  # drop an entry cut short by an interrupted write, so appends stay aligned
+            size -= size % _INDEX_ENTRY.size
+            self._index_file.truncate(size)
+        if not size:
+            return
+        with mmap.mmap(self._index_file.fileno(), size, access=mmap.ACCESS_READ) as view:
+            for digest, kind, block_offset, offset, length in _INDEX_ENTRY.iter_unpack(view):
+                self._index[digest] = (kind, block_offset, offset, length)
+
+    def stats(self) -> Dict[str, Any]:
+        self.flush()
+        with self._lock:
+            kinds = [kind for kind, *_ in self._index.values()]
+            return {
+                'feed_items': kinds.count(KIND_FEED_ITEM),
+                'receipts': kinds.count(KIND_RECEIPT),
+                'bytes': self._blocks_file.seek(0, 2),
+                'index_bytes': self._index_file.seek(0, 2),
+            }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive raw Woolies responses")
+    parser.add_argument('directory', help="archive directory")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('feed', help="archive every field of the whole activity feed")
+    import_parser = subparsers.add_parser('import', help="archive a store's raw receipts")
+    import_parser.add_argument('db', help="SQLite store path")
+    get_parser = subparsers.add_parser('get', help="print an archived record as JSON")
+    get_parser.add_argument('kind', choices=KINDS)
+    get_parser.add_argument('key', help="transaction id or receipt key")
+    subparsers.add_parser('stats', help="print the number of records & bytes archived")
+    args = parser.parse_args()
+
+    with Archive(args.directory) as _archive:
+        if args.command == 'feed':
+            from woolies import Transaction
+
+            _n_items = sum(_archive.add_feed_page(data) for data in Transaction.list_raw_pages(full=True))
+            print(f"archived {_n_items} new feed items")
+        elif args.command == 'import':
+            from store import Store
+
+            with Store(args.db) as _store:
+                _n_receipts = sum(_archive.add_receipt(receipt_id, json.loads(raw))
+                                  for rows in _store.iter_raw_receipt_rows(1000) for receipt_id, raw in rows)
+            print(f"archived {_n_receipts} new receipts")
+        elif args.command == 'get':
+            print(json.dumps(_archive.get(args.kind, args.key), indent=2))
+        else:
+            print(json.dumps(_archive.stats(), indent=2))
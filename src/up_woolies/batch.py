@@ -0,0 +1,160 @@
+"""
+Multi-tenant batch runner; syncs & reconciles many households, each with their own Up & Woolies tokens.
+
+Tenants run in a pool of worker processes, each tenant with its own sessions & store. Concurrent requests are bounded
+per API host across all workers & rate-limited per tenant. Results & failures are aggregated into one report.
+
+    $ python batch.py tenants.json --db-dir stores/ --workers 8 --report report.json
+
+where tenants.json is a list of `{"name": ..., "up_token": ..., "woolies_token": ...}` objects.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from multiprocessing import Manager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from pydantic import BaseModel, SecretStr
+
+DEFAULT_WORKERS = 8
+DEFAULT_HOST_CONCURRENCY = 8  # concurrent requests per API host, across all workers
+DEFAULT_TENANT_RATE = 5  # requests per second per tenant
+
+Result = Dict[str, Any]
+
+
+class Tenant(BaseModel):
+    """ Credentials of a household; tokens are kept out of reprs & reports """
+    name: str
+    up_token: SecretStr
+    woolies_token: SecretStr
+    db: Optional[str]  # store path; defaults to `<db-dir>/<name>.sqlite3`
+
+
+def api_hosts() -> List[str]:
+    import up
+    from woolies import api
+
+    return sorted({urlsplit(url).hostname for url in (up.endpoint, api.endpoint, api.endpoint_graphql)})
+
+
+def _init_worker(host_semaphores: Dict[str, Any]):
+    from utils import limits
+
+    limits.host_semaphores = host_semaphores
+
+
+def _isolate(tenant: Tenant, rate: float):
+    """ Points this process' shared sessions, metrics & rate-limit at tenant """
+    import up
+    from profiling import metrics
+    from utils import TokenBucket, limits
+    from woolies import api
+
+    os.environ['UP_TOKEN'] = tenant.up_token.get_secret_value()
+    os.environ['WOOLIES_TOKEN'] = tenant.woolies_token.get_secret_value()
+    for cached in (up.get_session, up.get_account_registry, api.get_session, api.get_gql_client):
+        cached.cache_clear()
+    metrics.reset()
+    limits.rate_limiter = TokenBucket(rate=rate)
+
+
+def run_tenant(tenant: Tenant,
+               db_dir: str = '.',
+               rate: float = DEFAULT_TENANT_RATE,
+               since: datetime = None,
+               until: datetime = None) -> Result:
+    """ Syncs & reconciles a tenant's store in this process; failures are reported rather than raised """
+    from main import sync
+    from profiling import metrics
+    from store import Store
+
+    start = time.perf_counter()
+    _isolate(tenant, rate)
+    result: Result = {'name': tenant.name}
+    try:
+        with redirect_stdout(io.StringIO()), Store(tenant.db or str(Path(db_dir) / f'{tenant.name}.sqlite3')) as store:
+            reconciliation = sync(store, since=since, until=until)
+        result.update(status='ok',
+                      matched=len(reconciliation.matched),
+                      unmatched=len(reconciliation.unmatched),
+                      ambiguous=len(reconciliation.ambiguous))
+    except Exception as e:
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+
+    endpoints = metrics.to_dict()['endpoints'].values()
+    result.update(elapsed=time.perf_counter() - start,
+                  requests=sum(stats['requests'] for stats in endpoints),
+                  retries=sum(stats['retries'] for stats in endpoints))
+    return result
+
+
+def run_batch(tenants: List[Tenant],
+              db_dir: str = '.',
+              workers: int = DEFAULT_WORKERS,
+              host_concurrency: int = DEFAULT_HOST_CONCURRENCY,
+              rate: float = DEFAULT_TENANT_RATE,
+              since: datetime = None,
+              until: datetime = None) -> List[Result]:
+    """ Returns results of running each tenant in a pool of worker processes; in the order given """
+    Path(db_dir).mkdir(parents=True, exist_ok=True)
+    with Manager() as manager:
+        host_semaphores = {host: manager.BoundedSemaphore(host_concurrency) for host in api_hosts()}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(host_semaphores,)) as executor:
+            futures = [executor.submit(run_tenant, tenant, db_dir, rate, since, until) for tenant in tenants]
+            results = []
+            for tenant, future in zip(tenants, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:  # e.g. a worker process died
+                    results.append({'name': tenant.name, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'})
+    return results
+
+
+def report(results: List[Result], elapsed: float):
+    from rich.console import Console
+    from rich.table import Table
+
+    counts = ['matched', 'unmatched', 'ambiguous', 'requests', 'retries']
+    table = Table('tenant', 'status', *counts, 'seconds', 'error', title='Batch')
+    for result in results:
+        table.add_row(result['name'], result['status'], *(str(result.get(key, '')) for key in counts),
+                      f"{result.get('elapsed', 0):.1f}", result.get('error', ''))
+    n_failed = sum(result['status'] != 'ok' for result in results)
+    console = Console()
+    console.print(table)
+    console.print(f"{len(results) - n_failed} succeeded, {n_failed} failed in {elapsed:.1f}s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync & reconcile many tenants in parallel")
+    parser.add_argument('tenants', help="JSON list of tenants with name, up_token, woolies_token & optional db")
+    parser.add_argument('--db-dir', default='.', help="directory of per-tenant stores")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--host-concurrency', type=int, default=DEFAULT_HOST_CONCURRENCY,
+                        help="concurrent requests per API host across all workers")
+    parser.add_argument('--rate', type=float, default=DEFAULT_TENANT_RATE, help="requests per second per tenant")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="ignore transactions before ISO date")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="ignore transactions after ISO date")
+    parser.add_argument('--report', help="write results to JSON path")
+    args = parser.parse_args()
+
+    with open(args.tenants) as f:
+        _tenants = [Tenant.parse_obj(tenant) for tenant in json.load(f)]
+    _start = time.perf_counter()
+    _results = run_batch(_tenants, db_dir=args.db_dir, workers=args.workers, host_concurrency=args.host_concurrency,
+                         rate=args.rate, since=args.since, until=args.until)
+    report(_results, time.perf_counter() - _start)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(_results, f, indent=2)
+    sys.exit(any(result['status'] != 'ok' for result in _results))
@@ -0,0 +1,188 @@
+"""
+Benchmarks for hot paths; e.g. `python bench.py receipts --save baseline.json` & later
+`python bench.py receipts --compare baseline.json` to catch parser regressions before they reach backfill jobs.
+`python bench.py transactions` measures decoding of 10k-item pages of Woolies & Up transactions.
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import synthetic
+import up
+from woolies import CompactReceipt, ReceiptDetails, Transaction
+
+
+def _count_lines(receipt: Dict[str, Any]) -> int:
+    return sum(len(detail['items']) for detail in receipt['receiptDetails']['details']
+               if detail['__typename'] == 'ReceiptDetailsItems')
+
+
+def measure(parse: Callable[[Dict[str, Any]], Any],
+            receipts: List[Dict[str, Any]],
+            repeat: int = 3) -> Dict[str, float]:
+    """
+    Returns best throughput of parse over receipts, & per receipt its mean peak of allocated memory & the number of
+    memory blocks it allocates for its result; see `_allocations`.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for receipt in receipts:
+            parse(receipt)
+        best = min(best, time.perf_counter() - start)
+
+    # Trace allocations separately; tracing slows parsing down
+    peak_bytes = 0
+    tracemalloc.start()
+    for receipt in receipts:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        parse(receipt)
+        peak_bytes += tracemalloc.get_traced_memory()[1] - before
+    allocations = _allocations(lambda: [parse(receipt) for receipt in receipts])
+    tracemalloc.stop()
+
+    return {
+        'receipts_per_sec': len(receipts) / best,
+        'items_per_sec': sum(map(_count_lines, receipts)) / best,
+        'peak_bytes_per_receipt': peak_bytes / len(receipts),
+        'allocations_per_receipt': allocations / len(receipts),
+    }
+
+
+def measure_page(decode: Callable[[], List[Any]], repeat: int = 3) -> Dict[str, float]:
+    """ Returns best throughput of decoding a page of objects, & per object its peak allocated memory & allocations """
+    best = float('inf')
+    n_objects = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_objects = len(decode())
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    decode()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    allocations = _allocations(decode)
+    tracemalloc.stop()
+
+    return {
+        'objects_per_sec': n_objects / best,
+        'peak_bytes_per_object': peak_bytes / n_objects,
+        'allocations_per_object': allocations / n_objects,
+    }
+
+
+def _allocations(run: Callable[[], Any]) -> int:
+    """
+    Returns the number of memory blocks allocated by run & still held by its result, from the block counts of traced
+    snapshots taken either side; i.e. the allocations its result costs, net of temporaries. Requires tracemalloc.
+    """
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]  # the snapshots' own allocations
+    before = tracemalloc.take_snapshot().filter_traces(filters)
+    result = run()
+    after = tracemalloc.take_snapshot().filter_traces(filters)
+    del result
+    return sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+
+
+def bench_receipts(count: int = 200, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    Returns results of `ReceiptDetails.from_raw` & its compact fast-path over synthetic corpora of each receipt size.
+    Raises AssertionError if the parse modes disagree.
+    """
+    results = {}
+    for size in synthetic.RECEIPT_SIZES:
+        receipts = synthetic.corpus(count, size=size, seed=seed)
+        for receipt in receipts:
+            assert CompactReceipt.from_raw(receipt).view() == ReceiptDetails.from_raw(receipt), "parse modes disagree"
+        results[f'from_raw/{size}'] = measure(ReceiptDetails.from_raw, receipts)
+        results[f'compact/{size}'] = measure(CompactReceipt.from_raw, receipts)
+    return results
+
+
+def bench_transactions(count: int = 10_000, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    Returns results of decoding pages of count Woolies & Up transactions; per item as before, in bulk, & in bulk from
+    trusted input, i.e. the local store. Raises AssertionError if the decode modes disagree.
+    """
+    feed_page = synthetic.feed_page(count, seed=seed)
+    feed_items = [(group['title'], item) for group in feed_page['rtlRewardsActivityFeed']['list']['groups']
+                  for item in group['items']]
+    woolies_rows = [transaction.json() for transaction in Transaction.from_page(feed_page)[0]]
+    up_resources = synthetic.up_page(count, seed=seed)
+    up_rows = [transaction.json() for transaction in up.Transaction.from_page(up_resources)]
+    assert Transaction.from_page(feed_page)[0] == Transaction.from_page(feed_page, trusted=True)[0] \
+           == Transaction.parse_rows(woolies_rows, trusted=True), "woolies decode modes disagree"
+    assert up.Transaction.from_page(up_resources) == up.Transaction.from_page(up_resources, trusted=True) \
+           == up.Transaction.parse_rows(up_rows, trusted=True), "up decode modes disagree"
+
+    return {
+        'woolies/from_response': measure_page(lambda: [Transaction.from_response(item, group_title=title)
+                                                       for title, item in feed_items]),
+        'woolies/from_page': measure_page(lambda: Transaction.from_page(feed_page)[0]),
+        'woolies/from_page trusted': measure_page(lambda: Transaction.from_page(feed_page, trusted=True)[0]),
+        'woolies/parse_rows': measure_page(lambda: Transaction.parse_rows(woolies_rows)),
+        'woolies/parse_rows trusted': measure_page(lambda: Transaction.parse_rows(woolies_rows, trusted=True)),
+        'up/validate': measure_page(lambda: [up.Transaction(id=resource['id'], **resource['attributes'])
+                                             for resource in up_resources]),
+        'up/from_page': measure_page(lambda: up.Transaction.from_page(up_resources)),
+        'up/from_page trusted': measure_page(lambda: up.Transaction.from_page(up_resources, trusted=True)),
+        'up/parse_rows': measure_page(lambda: up.Transaction.parse_rows(up_rows)),
+        'up/parse_rows trusted': measure_page(lambda: up.Transaction.parse_rows(up_rows, trusted=True)),
+    }
+
+
+BENCHMARKS = {
+    'receipts': bench_receipts,
+    'transactions': bench_transactions,
+}
+
+
+def report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]] = None,
+           tolerance: float = 0.2) -> bool:
+    """ Prints results & returns whether they regressed past tolerance of baseline throughput """
+    from rich.console import Console
+    from rich.table import Table
+
+    unit = 'receipt' if all('receipts_per_sec' in result for result in results.values()) else 'object'
+    table = Table('benchmark', f'{unit}s/sec', 'items/sec', f'peak KiB/{unit}', f'allocs/{unit}', 'vs. baseline')
+    is_regressed = False
+    for name, result in results.items():
+        change = ''
+        if baseline is not None and name in baseline:
+            ratio = result[f'{unit}s_per_sec'] / baseline[name][f'{unit}s_per_sec']
+            change = f'{ratio - 1:+.1%}'
+            if ratio < 1 - tolerance:
+                is_regressed = True
+                change = f'[red]{change}[/red]'
+        items_per_sec = f"{result['items_per_sec']:,.0f}" if 'items_per_sec' in result else ''
+        table.add_row(name, f"{result[f'{unit}s_per_sec']:,.0f}", items_per_sec,
+                      f"{result[f'peak_bytes_per_{unit}'] / 1024:,.1f}",
+                      f"{result[f'allocations_per_{unit}']:,.0f}", change)
+    Console().print(table)
+    return is_regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark up_woolies hot paths")
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    parser.add_argument('--count', type=int, help="receipts per corpus, or transactions per page (default: 200 & 10k)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help="write results as JSON to path")
+    parser.add_argument('--compare', help="compare against JSON results from path; exits 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed throughput drop (default: %(default)s)")
+    args = parser.parse_args()
+
+    _results = BENCHMARKS[args.benchmark](**({'count': args.count} if args.count else {}), seed=args.seed)
+    _baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            _baseline = json.load(f)
+    _is_regressed = report(_results, _baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(_results, f, indent=2)
+    sys.exit(1 if _is_regressed else 0)
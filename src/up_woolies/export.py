@@ -0,0 +1,131 @@
+"""
+Streaming export of itemised purchase history to columnar files; Parquet or Arrow via optional `pyarrow`, with CSV &
+NDJSON fallbacks. Rows are written in fixed-size batches, so memory stays flat however much history is exported.
+"""
+import csv
+import json
+from decimal import Decimal
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import up
+import woolies
+
+COLUMNS = ['date', 'origin', 'partner', 'up_transaction_id', 'description', 'amount', 'quantity', 'weight']
+FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+DEFAULT_BATCH_SIZE = 1000
+
+Row = Dict[str, Any]
+
+
+def iter_rows(matched: Iterable[Tuple[woolies.Transaction, up.Transaction]]) -> Iterator[Row]:
+    """ Yields a row per purchased item of each matched Woolies & Up transaction pair """
+    for woolies_transaction, up_transaction in matched:
+        for item in woolies_transaction.receipt().items:
+            yield {
+                'date': up_transaction.createdAt,
+                'origin': woolies_transaction.origin,
+                'partner': woolies_transaction.partner,
+                'up_transaction_id': str(up_transaction.id),
+                'description': item.description,
+                'amount': item.amount,
+                'quantity': item.quantity,
+                'weight': item.weight,
+            }
+
+
+class _CsvWriter:
+    def __init__(self, path: Path):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        self._writer.writeheader()
+
+    def write_batch(self, rows: List[Row]):
+        self._writer.writerows({**row, 'date': row['date'].isoformat('T')} for row in rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _NdjsonWriter:
+    def __init__(self, path: Path):
+        self._file = open(path, 'w')
+
+    def write_batch(self, rows: List[Row]):
+        self._file.writelines(json.dumps(row, default=_json_default) + '\n' for row in rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _ArrowWriter:
+    """ Writes Parquet or Arrow IPC files via pyarrow """
+
+    def __init__(self, path: Path, file_format: str):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError(f"pyarrow is required for {file_format} export; try csv or ndjson instead") from None
+
+        self._pa = pa
+        self._schema = pa.schema([
+            ('date', pa.timestamp('us', tz='UTC')),
+            ('origin', pa.string()),
+            ('partner', pa.string()),
+            ('up_transaction_id', pa.string()),
+            ('description', pa.string()),
+            ('amount', pa.decimal128(12, 2)),
+            ('quantity', pa.int32()),
+            ('weight', pa.decimal128(12, 3)),
+        ])
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(str(path), self._schema)
+        else:
+            self._writer = pa.ipc.new_file(str(path), self._schema)
+
+    def write_batch(self, rows: List[Row]):
+        columns = {column: [row[column] for row in rows] for column in COLUMNS}
+        self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def _json_default(value: Any):
+    if isinstance(value, Decimal):
+        return str(value)  # exact, unlike float
+    if hasattr(value, 'isoformat'):
+        return value.isoformat('T')
+    raise TypeError(f"cannot serialise {type(value)}")
+
+
+def export(rows: Iterable[Row], path: str, file_format: str = None, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Streams rows to path in batches of batch_size & returns the number of rows written.
+
+    :param file_format: one of parquet, arrow, csv or ndjson; inferred from path's suffix by default.
+    """
+    path = Path(path)
+    if (file_format := file_format or FORMATS.get(path.suffix)) is None:
+        raise ValueError(f"could not infer export format from {path.name}; expected one of {sorted(FORMATS)}")
+
+    if file_format in ('parquet', 'arrow'):
+        writer = _ArrowWriter(path, file_format)
+    elif file_format == 'csv':
+        writer = _CsvWriter(path)
+    elif file_format == 'ndjson':
+        writer = _NdjsonWriter(path)
+    else:
+        raise ValueError(f"unsupported export format {file_format!r}")
+
+    n_rows = 0
+    rows = iter(rows)
+    try:
+        while batch := list(islice(rows, batch_size)):
+            writer.write_batch(batch)
+            n_rows += len(batch)
+    finally:
+        writer.close()
+    return n_rows
@@ -1,62 +1,122 @@
-import datetime
+import argparse
 import json
+import os
+from datetime import datetime
+from typing import TYPE_CHECKING
 
-from rich import print
+# N.B. heavy imports are deferred to keep CLI start-up snappy
+if TYPE_CHECKING:
+    from reconcile import Reconciliation
+    from store import Store
 
-import up
-import woolies
 
-up_accounts = up.AllSpendingAccounts()
+def sync(store: 'Store', since: datetime = None, until: datetime = None) -> 'Reconciliation':
+    """ Syncs store with both APIs & returns reconciliation of stored Woolworths transactions within date bounds """
+    from rich import print
 
+    from reconcile import MATCH_WINDOW, Reconciliation, reconcile
+    from search import SearchIndex
 
-def find_corresponding_up_transaction(woolies_transaction: woolies.Transaction) -> up.Transaction:
-    """ Returns corresponding Up Bank transaction from a Woolies transaction"""
-    _up_category = 'groceries'
-    _up_description = 'Woolworths'  # How Up manages human-readable merchant Id for Woolworths
+    store.sync_woolies(since=since)
 
-    # Request transactions within window of the Woolies transaction
-    transaction_datetime = woolies_transaction.date
-    for up_transactions in up_accounts.get_transactions(since=transaction_datetime - datetime.timedelta(minutes=10),
-                                                        until=transaction_datetime + datetime.timedelta(minutes=10),
-                                                        category=_up_category):
-        for up_transaction in up_transactions:
-            # Validate transactions match
-            is_merchant_woolies = up_transaction.description == _up_description
-            is_money_spent_equal = up_transaction.value == woolies_transaction.amount_paid()
-            if is_merchant_woolies and is_money_spent_equal:
-                return up_transaction
-        else:
+    # Filter out Woolworth partners
+    woolies_transactions = []
+    for woolies_transaction in store.woolies_transactions(since=since, until=until):
+        if (partner := woolies_transaction.partner) != 'woolworths':
+            print(f"ignoring {partner=} transaction", woolies_transaction.display_name, woolies_transaction.date)
             continue
-    else:
-        raise FileNotFoundError("could not find corresponding transaction with up bank")
+        woolies_transactions.append(woolies_transaction)
+    if not woolies_transactions:
+        return Reconciliation()
 
+    # Load receipts, fetching only new ones; matching compares against amount paid on receipt
+    store.sync_receipts(woolies_transactions)
+    SearchIndex(store.connection).add_transactions(woolies_transactions)
 
-def example():
-    for transactions in woolies.Transaction.list_transactions():
-        for woolies_transaction in transactions:
+    # Reconcile only transactions not matched by an earlier sync, against Up transactions not yet claimed
+    matched = store.matched(woolies_transactions)
+    matched_ids = {woolies_transaction.id for woolies_transaction, _ in matched}
+    if not (pending := [woolies_transaction for woolies_transaction in woolies_transactions
+                        if woolies_transaction.id not in matched_ids]):
+        reconciliation = Reconciliation()
+        reconciliation.matched = matched
+        return reconciliation
 
-            # Filter out Woolworth partners
-            if (partner := woolies_transaction.partner) != 'woolworths':
-                print(f"ignoring {partner=} transaction", woolies_transaction.display_name, woolies_transaction.date)
-                continue
+    # Find Up transactions in bulk
+    dates = [woolies_transaction.date for woolies_transaction in pending]
+    up_transactions = store.sync_up(since=min(dates) - MATCH_WINDOW, until=max(dates) + MATCH_WINDOW)
+    claimed_ids = store.matched_up_transaction_ids()
+    reconciliation = reconcile(pending, [up_transaction for up_transaction in up_transactions
+                                         if str(up_transaction.id) not in claimed_ids])
+    with store.connection:
+        store.add_matches(reconciliation.matched)
 
-            # Find Up transaction
-            try:
-                up_transaction = find_corresponding_up_transaction(woolies_transaction)
-            except FileNotFoundError:
-                print(f"couldn't find an Up Banking transaction with {partner} at {woolies_transaction.date}")
-                continue
+    # Keep feed order across previous & new matches
+    order = {woolies_transaction.id: i for i, woolies_transaction in enumerate(woolies_transactions)}
+    reconciliation.matched = sorted(matched + reconciliation.matched, key=lambda pair: order[pair[0].id])
+    return reconciliation
 
-            # Grab receipt and show
-            woolies_receipt = woolies_transaction.receipt()
 
-            # Print it but make it pretty
-            print({
-                'date': up_transaction.createdAt.astimezone().isoformat('T'),
-                'partner': woolies_transaction.partner,
-                **json.loads(woolies_receipt.json(exclude={'date'}))
-            })
+def example(db_path: str = None,
+            since: datetime = None,
+            until: datetime = None,
+            export_path: str = None,
+            export_format: str = None):
+    from rich import print
+
+    from store import DEFAULT_PATH, Store
+
+    with Store(db_path or DEFAULT_PATH) as store:
+        reconciliation = sync(store, since=since, until=until)
+
+    for woolies_transaction in reconciliation.unmatched:
+        print(f"couldn't find an Up Banking transaction with {woolies_transaction.partner} at "
+              f"{woolies_transaction.date}")
+    for woolies_transaction, up_transactions in reconciliation.ambiguous:
+        print(f"found {len(up_transactions)} candidate Up Banking transactions with {woolies_transaction.partner} at "
+              f"{woolies_transaction.date}; skipping")
+
+    if export_path is not None:
+        from export import export, iter_rows
+
+        n_rows = export(iter_rows(reconciliation.matched), export_path, file_format=export_format)
+        print(f"exported {n_rows} purchased items to {export_path}")
+        return
+
+    for woolies_transaction, up_transaction in reconciliation.matched:
+        # Grab receipt and show
+        woolies_receipt = woolies_transaction.receipt()
+
+        # Print it but make it pretty
+        print({
+            'date': up_transaction.createdAt.astimezone().isoformat('T'),
+            'partner': woolies_transaction.partner,
+            **json.loads(woolies_receipt.json(exclude={'date'}))
+        })
 
 
 if __name__ == '__main__':
-    example()
+    parser = argparse.ArgumentParser(description="Itemised breakdown of Woolworths transactions made with Up Bank")
+    parser.add_argument('--db', help="path to local store (default: $UP_WOOLIES_DB or up_woolies.sqlite3)")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="ignore transactions before ISO date")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="ignore transactions after ISO date")
+    parser.add_argument('--export', help="export purchased items to path instead of printing")
+    parser.add_argument('--format', choices=['parquet', 'arrow', 'csv', 'ndjson'],
+                        help="export format (default: inferred from --export suffix)")
+    parser.add_argument('--record', help="record API responses to directory, for replay.py")
+    parser.add_argument('--profile', action='store_true', help="print HTTP & stage timings to stderr")
+    parser.add_argument('--metrics-out',
+                        help="write HTTP & stage metrics to path; Prometheus text for .prom, otherwise JSON")
+    args = parser.parse_args()
+    if args.record:
+        os.environ['UP_WOOLIES_RECORD'] = args.record  # read as sessions are created
+    try:
+        example(db_path=args.db, since=args.since, until=args.until, export_path=args.export, export_format=args.format)
+    finally:
+        if args.profile or args.metrics_out:
+            from profiling import metrics
+
+            if args.profile:
+                metrics.print_summary()
+            if args.metrics_out:
+                metrics.dump(args.metrics_out)
@@ -0,0 +1,126 @@
+"""
+Bounded-memory streaming reconciliation; for processing years of history in constant memory.
+
+Stages run concurrently, connected by bounded buffers, so that a slow stage holds back the stages before it:
+
+    feed pages → parse → filter partner → fetch receipts → match against Up → records
+
+Each stage works a page at a time & each receipt is released once its record has been consumed. Memory is therefore
+capped by the buffer depth rather than the length of history. N.B. Up transactions are matched per feed page, so an Up
+transaction claimed across a page boundary is not detected as ambiguous, unlike `reconcile.reconcile`.
+
+    >>> for record in stream(since=datetime(2021, 1, 1)):
+    ...     if record.status == 'matched':
+    ...         print(record.up_transaction.createdAt, record.woolies_transaction.receipt().items)
+"""
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Literal, NamedTuple, Optional
+
+import up
+import woolies
+from reconcile import MATCH_WINDOW, fetch_up_transactions, reconcile
+from utils import buffered
+from woolies.interfaces import DEFAULT_RECEIPT_WORKERS, as_local_naive
+
+DEFAULT_BUFFER = 2  # pages buffered between stages
+DEFAULT_PARTNER = 'woolworths'
+
+Page = List[woolies.Transaction]
+
+
+class Record(NamedTuple):
+    woolies_transaction: woolies.Transaction
+    up_transaction: Optional[up.Transaction]
+    status: Literal['matched', 'unmatched', 'ambiguous']
+
+
+def parse(pages: Iterable[Dict[str, Any]], since: datetime = None, until: datetime = None) -> Iterator[Page]:
+    """ Yields transactions of raw feed pages within date bounds; stops once the feed is older than `since` """
+    since, until = as_local_naive(since), as_local_naive(until)
+    for data in pages:
+        transactions, is_exhausted = woolies.Transaction.from_page(data, since=since, until=until)
+        yield transactions
+        if is_exhausted:
+            return
+
+
+def filter_partner(pages: Iterable[Page], partner: str = DEFAULT_PARTNER) -> Iterator[Page]:
+    """ Yields non-empty pages of partner's transactions with e-receipts """
+    for transactions in pages:
+        if transactions := [transaction for transaction in transactions
+                            if transaction.partner == partner and transaction.receiptId is not None]:
+            yield transactions
+
+
+def fetch_receipts(pages: Iterable[Page], max_workers: int = DEFAULT_RECEIPT_WORKERS) -> Iterator[Page]:
+    """ Yields pages after filling each transaction's receipt cache; receipts are fetched concurrently per page """
+    for transactions in pages:
+        woolies.fetch_receipts(transactions, max_workers=max_workers)
+        yield transactions
+
+
+def match(pages: Iterable[Page],
+          window: timedelta = MATCH_WINDOW,
+          accounts: up.AllSpendingAccounts = None) -> Iterator[Record]:
+    """ Yields a record per transaction in feed order, reconciled against Up transactions around its page """
+    accounts = accounts or up.AllSpendingAccounts()
+    for transactions in pages:
+        dates = [transaction.date for transaction in transactions]
+        up_transactions = fetch_up_transactions(since=min(dates) - window, until=max(dates) + window,
+                                                accounts=accounts)
+        reconciliation = reconcile(transactions, up_transactions, window=window)
+        records = {woolies_transaction.id: Record(woolies_transaction, up_transaction, 'matched')
+                   for woolies_transaction, up_transaction in reconciliation.matched}
+        records.update((woolies_transaction.id, Record(woolies_transaction, None, 'unmatched'))
+                       for woolies_transaction in reconciliation.unmatched)
+        records.update((woolies_transaction.id, Record(woolies_transaction, None, 'ambiguous'))
+                       for woolies_transaction, _ in reconciliation.ambiguous)
+        for transaction in transactions:
+            yield records[transaction.id]
+
+
+def stream(since: datetime = None,
+           until: datetime = None,
+           partner: str = DEFAULT_PARTNER,
+           window: timedelta = MATCH_WINDOW,
+           buffer: int = DEFAULT_BUFFER,
+           page_token: str = woolies.FIRST_PAGE_TOKEN) -> Generator[Record, None, None]:
+    """
+    Yields reconciled records of partner's transactions, newest first, from a pipeline of concurrent stages.
+
+    A record's receipt is released as the next record is requested; use or copy it before then.
+
+    :param buffer: pages buffered between stages; bounds memory & read-ahead.
+    """
+    pages = buffered(woolies.Transaction.list_raw_pages(page_token=page_token), buffer, name='pipeline-feed')
+    pages = buffered(filter_partner(parse(pages, since, until), partner), buffer, name='pipeline-parse')
+    pages = buffered(fetch_receipts(pages), buffer, name='pipeline-receipts')
+    try:
+        for record in match(pages, window=window):
+            yield record
+            record.woolies_transaction.release_receipt()
+    finally:
+        pages.close()  # stops each upstream stage in turn
+
+
+if __name__ == '__main__':
+    from export import export, iter_rows
+
+    parser = argparse.ArgumentParser(description="Stream itemised purchases to a file in constant memory")
+    parser.add_argument('path', help="export path; as per main.py --export")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="ignore transactions before ISO date")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="ignore transactions after ISO date")
+    parser.add_argument('--buffer', type=int, default=DEFAULT_BUFFER, help="pages buffered between stages")
+    args = parser.parse_args()
+
+    _counts = {'matched': 0, 'unmatched': 0, 'ambiguous': 0}
+
+    def _matched(records: Iterable[Record]):
+        for record in records:
+            _counts[record.status] += 1
+            if record.status == 'matched':
+                yield record.woolies_transaction, record.up_transaction
+
+    n_rows = export(iter_rows(_matched(stream(since=args.since, until=args.until, buffer=args.buffer))), args.path)
+    print(f"exported {n_rows} purchased items to {args.path}; {_counts}")
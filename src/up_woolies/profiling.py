@@ -0,0 +1,219 @@
+"""
+Process-wide instrumentation of HTTP requests & processing stages.
+
+Sessions from `utils.new_session` record each response's latency, bytes, status & retries per endpoint, & `stage()`
+times the main processing stages; e.g. feed fetch, `from_response`, receipt fetch, `from_raw` & matching. Stage
+timings are inclusive, so nested stages also count towards their parents. Point-in-time stats of other components, e.g.
+each host's adaptive concurrency limit from `utils.limits`, are included via registered sources.
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List
+from urllib.parse import urlsplit
+
+from requests import Response
+
+# Collapse ids out of URL paths to keep the number of endpoints bounded
+PATTERN_PATH_ID = re.compile(r'/(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)(?=/|$)')
+
+CIRCUIT_OPENNESS = {'closed': 0, 'half-open': 0.5, 'open': 1}
+
+LATENCY_RESERVOIR_SIZE = 1024  # latency samples kept per endpoint for percentiles; bounds memory of long runs
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.statuses: Dict[int, int] = defaultdict(int)
+        self.latency_total = 0.
+        self.latency_max = 0.
+        self.latencies: List[float] = []  # uniform random sample of every latency observed; i.e. a reservoir
+        self._random = random.Random()
+
+    def observe_latency(self, latency: float):
+        """ Adds latency to the totals & the reservoir; N.B. `requests` is expected to already count it """
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if len(self.latencies) < LATENCY_RESERVOIR_SIZE:
+            self.latencies.append(latency)
+        elif (i := self._random.randrange(self.requests)) < LATENCY_RESERVOIR_SIZE:
+            self.latencies[i] = latency
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'statuses': dict(self.statuses),
+            'latency_total': self.latency_total,
+            'latency_p50': _percentile(self.latencies, 0.50),
+            'latency_p95': _percentile(self.latencies, 0.95),
+            'latency_max': self.latency_max,
+        }
+
+
+class StageStats:
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.
+        self.max = 0.
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'calls': self.calls, 'total': self.total, 'max': self.max}
+
+
+class Metrics:
+    """ Thread-safe registry of endpoint & stage statistics """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self.stages: Dict[str, StageStats] = defaultdict(StageStats)
+        self.sources: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def register_source(self, name: str, source: Callable[[], Dict[str, Any]]):
+        """ Includes source's stats under name; sources are read on export & outlive `reset()` """
+        self.sources[name] = source
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.stages.clear()
+
+    def observe_request(self, endpoint: str, latency: float, n_bytes: int, status: int, retries: int = 0):
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats.requests += 1
+            stats.retries += retries
+            stats.bytes += n_bytes
+            stats.statuses[status] += 1
+            stats.observe_latency(latency)
+
+    def observe_response(self, response: Response, *args, **kwargs):
+        """ Response hook for requests.Session """
+        retry = getattr(response.raw, 'retries', None)
+        self.observe_request(endpoint=endpoint_name(response.request.method, response.url),
+                             latency=response.elapsed.total_seconds(),
+                             n_bytes=len(response.content or b''),
+                             status=response.status_code,
+                             retries=len(retry.history) if retry is not None else 0)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Times enclosed block as a stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stats = self.stages[name]
+                stats.calls += 1
+                stats.total += elapsed
+                stats.max = max(stats.max, elapsed)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            data = {
+                'endpoints': {name: stats.to_dict() for name, stats in self.endpoints.items()},
+                'stages': {name: stats.to_dict() for name, stats in self.stages.items()},
+            }
+        data.update((name, source()) for name, source in self.sources.items())
+        return data
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """ Returns metrics in Prometheus' text exposition format """
+        data = self.to_dict()
+        lines = []
+
+        def metric(name: str, kind: str, help_: str, samples: List[str]):
+            lines.extend([f'# HELP up_woolies_{name} {help_}', f'# TYPE up_woolies_{name} {kind}', *samples])
+
+        endpoints = data['endpoints'].items()
+        metric('http_requests_total', 'counter', 'HTTP responses by endpoint & status.',
+               [f'up_woolies_http_requests_total{{endpoint="{name}",status="{status}"}} {count}'
+                for name, stats in endpoints for status, count in stats['statuses'].items()])
+        metric('http_retries_total', 'counter', 'HTTP retries by endpoint.',
+               [f'up_woolies_http_retries_total{{endpoint="{name}"}} {stats["retries"]}' for name, stats in endpoints])
+        metric('http_response_bytes_total', 'counter', 'HTTP response bytes by endpoint.',
+               [f'up_woolies_http_response_bytes_total{{endpoint="{name}"}} {stats["bytes"]}'
+                for name, stats in endpoints])
+        metric('http_latency_seconds_total', 'counter', 'Total HTTP latency by endpoint.',
+               [f'up_woolies_http_latency_seconds_total{{endpoint="{name}"}} {stats["latency_total"]}'
+                for name, stats in endpoints])
+        metric('stage_seconds_total', 'counter', 'Total time spent per processing stage.',
+               [f'up_woolies_stage_seconds_total{{stage="{name}"}} {stats["total"]}'
+                for name, stats in data['stages'].items()])
+        metric('stage_calls_total', 'counter', 'Calls per processing stage.',
+               [f'up_woolies_stage_calls_total{{stage="{name}"}} {stats["calls"]}'
+                for name, stats in data['stages'].items()])
+        hosts = data.get('hosts', {}).items()
+        metric('host_concurrency_limit', 'gauge', 'Adaptive limit of in-flight requests by host.',
+               [f'up_woolies_host_concurrency_limit{{host="{name}"}} {stats["limit"]}' for name, stats in hosts])
+        metric('host_in_flight', 'gauge', 'In-flight requests by host.',
+               [f'up_woolies_host_in_flight{{host="{name}"}} {stats["in_flight"]}' for name, stats in hosts])
+        metric('host_circuit_open', 'gauge', 'Whether the circuit breaker of a host is open; 0.5 when half-open.',
+               [f'up_woolies_host_circuit_open{{host="{name}"}} {CIRCUIT_OPENNESS[stats["state"]]}'
+                for name, stats in hosts])
+        for counter in ('failures', 'throttled', 'decreases', 'trips', 'rejected'):
+            metric(f'host_{counter}_total', 'counter', f'Adaptive concurrency {counter} by host.',
+                   [f'up_woolies_host_{counter}_total{{host="{name}"}} {stats[counter]}' for name, stats in hosts])
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        """ Writes metrics to path; as Prometheus text for .prom or .txt, otherwise JSON """
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json())
+
+    def print_summary(self):
+        from rich.console import Console
+        from rich.table import Table
+
+        data = self.to_dict()
+        endpoints = Table('endpoint', 'requests', 'retries', 'statuses', 'KiB', 'total s', 'p50 ms', 'p95 ms',
+                          title='HTTP')
+        for name, stats in sorted(data['endpoints'].items()):
+            endpoints.add_row(name, str(stats['requests']), str(stats['retries']),
+                              ' '.join(f'{status}×{count}' for status, count in sorted(stats['statuses'].items())),
+                              f"{stats['bytes'] / 1024:,.1f}", f"{stats['latency_total']:.2f}",
+                              f"{stats['latency_p50'] * 1000:.0f}", f"{stats['latency_p95'] * 1000:.0f}")
+        stages = Table('stage', 'calls', 'total s', 'max s', title='Stages (inclusive)')
+        for name, stats in sorted(data['stages'].items(), key=lambda item: -item[1]['total']):
+            stages.add_row(name, str(stats['calls']), f"{stats['total']:.3f}", f"{stats['max']:.3f}")
+        hosts = Table('host', 'limit', 'in-flight', 'circuit', 'requests', 'failures', 'throttled', 'decreases',
+                      'trips', 'rejected', title='Hosts (adaptive concurrency)')
+        for name, stats in sorted(data.get('hosts', {}).items()):
+            hosts.add_row(name, str(stats['limit']), str(stats['in_flight']), stats['state'],
+                          *(str(stats[key]) for key in ('requests', 'failures', 'throttled', 'decreases', 'trips',
+                                                        'rejected')))
+        console = Console(stderr=True)
+        console.print(endpoints)
+        console.print(stages)
+        if hosts.row_count:
+            console.print(hosts)
+
+
+def endpoint_name(method: str, url: str) -> str:
+    """ Returns endpoint name of request; e.g. 'GET api.up.com.au/api/v1/accounts/{id}/transactions' """
+    parts = urlsplit(url)
+    return f'{method} {parts.netloc}{PATTERN_PATH_ID.sub("/{id}", parts.path)}'
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+metrics = Metrics()
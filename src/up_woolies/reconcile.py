@@ -0,0 +1,122 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+import up
+import woolies
+from profiling import metrics
+
+UP_CATEGORY = 'groceries'
+UP_DESCRIPTION = 'Woolworths'  # How Up manages human-readable merchant Id for Woolworths
+MATCH_WINDOW = timedelta(minutes=10)  # Woolies' transaction date may vary from eftpos date by several minutes
+
+
+class Reconciliation:
+    """ Result of joining Woolies transactions against Up transactions """
+
+    def __init__(self):
+        self.matched: List[Tuple[woolies.Transaction, up.Transaction]] = []
+        self.unmatched: List[woolies.Transaction] = []
+        self.ambiguous: List[Tuple[woolies.Transaction, List[up.Transaction]]] = []
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(matched={len(self.matched)}, unmatched={len(self.unmatched)}, "
+                f"ambiguous={len(self.ambiguous)})")
+
+
+class UpTransactionIndex:
+    """ Up transactions indexed by (description, value) & sorted by creation time for windowed lookups """
+
+    def __init__(self, up_transactions: Iterable[up.Transaction]):
+        buckets: Dict[Tuple[str, Decimal], List[Tuple[float, up.Transaction]]] = defaultdict(list)
+        for up_transaction in up_transactions:
+            if up_transaction.createdAt is None:
+                continue
+            buckets[(up_transaction.description, up_transaction.value)].append(
+                (up_transaction.createdAt.timestamp(), up_transaction))
+
+        self._timestamps: Dict[Tuple[str, Decimal], List[float]] = {}
+        self._transactions: Dict[Tuple[str, Decimal], List[up.Transaction]] = {}
+        for key, bucket in buckets.items():
+            bucket.sort(key=lambda pair: pair[0])
+            self._timestamps[key] = [timestamp for timestamp, _ in bucket]
+            self._transactions[key] = [transaction for _, transaction in bucket]
+
+    def __len__(self):
+        return sum(len(transactions) for transactions in self._transactions.values())
+
+    def candidates(self,
+                   description: str,
+                   value: Decimal,
+                   date: datetime,
+                   window: timedelta = MATCH_WINDOW) -> List[up.Transaction]:
+        """ Returns Up transactions of matching description & value created within window of date """
+        key = (description, value)
+        if (timestamps := self._timestamps.get(key)) is None:
+            return []
+        centre = date.astimezone().timestamp()
+        lo = bisect_left(timestamps, centre - window.total_seconds())
+        hi = bisect_right(timestamps, centre + window.total_seconds())
+        return self._transactions[key][lo:hi]
+
+
+def fetch_up_transactions(since: datetime,
+                          until: datetime,
+                          accounts: Optional[up.AllSpendingAccounts] = None) -> List[up.Transaction]:
+    """ Returns all Up grocery transactions within date span in as few page requests as possible """
+    accounts = accounts or up.AllSpendingAccounts()
+    return [transaction
+            for transactions in accounts.get_transactions(since=since,
+                                                          until=until,
+                                                          category=UP_CATEGORY,
+                                                          prefetch=up.BULK_PREFETCH)
+            for transaction in transactions]
+
+
+def reconcile(woolies_transactions: Iterable[woolies.Transaction],
+              up_transactions: Optional[Iterable[up.Transaction]] = None,
+              window: timedelta = MATCH_WINDOW) -> Reconciliation:
+    """
+    Returns reconciliation of Woolies transactions against their corresponding Up transactions.
+
+    Up transactions for the whole date span of the Woolies transactions are requested once, unless provided, & joined
+    via an index of (description, value) so the number of Up requests scale with pages rather than transactions.
+    A Woolies transaction is ambiguous when several Up transactions fit, or when its only fit is claimed by another.
+
+    :param woolies_transactions: Woolies transactions with e-receipts to reconcile.
+    :param up_transactions: optional pre-fetched Up transactions; otherwise fetched for the Woolies date span.
+    :param window: allowed difference between Woolies' rough transaction date & Up's creation date.
+    """
+    woolies_transactions = list(woolies_transactions)
+    result = Reconciliation()
+    if not woolies_transactions:
+        return result
+
+    if up_transactions is None:
+        dates = [transaction.date for transaction in woolies_transactions]
+        up_transactions = fetch_up_transactions(since=min(dates) - window, until=max(dates) + window)
+    up_transactions = list(up_transactions)  # drain any lazy fetch outside of the matching stage
+
+    # Find candidates for each Woolies transaction & note which Up transactions are claimed more than once
+    with metrics.stage('match'):
+        index = UpTransactionIndex(up_transactions)
+        candidates: List[Tuple[woolies.Transaction, List[up.Transaction]]] = []
+        claims: Dict[UUID, int] = defaultdict(int)
+        for woolies_transaction in woolies_transactions:
+            found = index.candidates(UP_DESCRIPTION, woolies_transaction.amount_paid(), woolies_transaction.date,
+                                     window)
+            candidates.append((woolies_transaction, found))
+            for up_transaction in found:
+                claims[up_transaction.id] += 1
+
+    for woolies_transaction, found in candidates:
+        if not found:
+            result.unmatched.append(woolies_transaction)
+        elif len(found) == 1 and claims[found[0].id] == 1:
+            result.matched.append((woolies_transaction, found[0]))
+        else:
+            result.ambiguous.append((woolies_transaction, found))
+    return result
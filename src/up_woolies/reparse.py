@@ -0,0 +1,104 @@
+"""
+Re-derives every stored parsed receipt from its raw e-receipt; e.g. after the parsing rules of `ReceiptDetails.from_raw`
+change. Raw receipts past Woolies' retention can't be re-downloaded, so the store's raw responses are the archive.
+
+Raw receipts are streamed from the store in chunks to a pool of worker processes, which decode, parse & encode them; so
+throughput scales with cores. Receipts that fail to parse, e.g. on an unforeseen edge case, are reported rather than
+aborting the run. Results are written back in one transaction, along with the search index rebuilt from them; the
+parsed receipts & search postings are replaced all at once or not at all.
+
+    $ python reparse.py --db up_woolies.sqlite3 --workers 8 --report failures.json
+"""
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterator, List, Tuple
+
+from pydantic import ValidationError
+
+from search import SearchIndex
+from store import DEFAULT_PATH, Store, encode_receipt
+from woolies import ReceiptDetails
+
+DEFAULT_CHUNK_SIZE = 250  # receipts per task
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+Failure = Dict[str, str]
+
+
+def parse_chunk(rows: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], List[Failure]]:
+    """ Returns (receipt id, `encode_receipt`) rows & failures of a chunk of (receipt id, raw JSON) rows """
+    parsed, failures = [], []
+    for receipt_id, raw in rows:
+        try:
+            parsed.append((receipt_id, encode_receipt(ReceiptDetails.from_raw(json.loads(raw)))))
+        except (ValueError, KeyError, TypeError, ValidationError) as e:
+            failures.append({'receipt_id': receipt_id, 'error': f'{type(e).__name__}: {e}'})
+    return parsed, failures
+
+
+def reparse(store: Store,
+            workers: int = DEFAULT_WORKERS,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[int, List[Failure]]:
+    """
+    Replaces store's parsed receipts with those re-derived from its raw receipts, & re-indexes the transactions
+    already indexed for search, then returns the number parsed & the failures. Failed receipts are left without a
+    parsed receipt or search postings. Up to two chunks per worker are in flight at once, bounding memory whatever the
+    size of the archive.
+    """
+    n_parsed, failures = 0, []
+    index = SearchIndex(store.connection)  # creating its tables commits, so before the transaction begins
+    with store.connection, ProcessPoolExecutor(max_workers=workers) as executor:
+        store.connection.execute("DELETE FROM parsed_receipts")
+        pending: Deque[Future] = deque()
+
+        def collect():
+            nonlocal n_parsed
+            parsed, chunk_failures = pending.popleft().result()
+            store.add_encoded_receipts(parsed)
+            n_parsed += len(parsed)
+            failures.extend(chunk_failures)
+
+        for rows in store.iter_raw_receipt_rows(chunk_size):
+            pending.append(executor.submit(parse_chunk, rows))
+            if len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+        indexed = store.connection.execute("SELECT transaction_id, receipt_id FROM search_documents "
+                                           "JOIN woolies_transactions ON id = transaction_id").fetchall()
+        index.reindex(_documents(store, indexed, chunk_size))
+    return n_parsed, failures
+
+
+def _documents(store: Store, rows: List[Tuple[str, str]], chunk_size: int) -> Iterator[Tuple[str, ReceiptDetails]]:
+    # Yields (transaction id, parsed receipt) of (transaction id, receipt id) rows, decoding a chunk at a time
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        receipts = store.parsed_receipts(receipt_id for _, receipt_id in chunk)
+        yield from ((transaction_id, receipts[receipt_id]) for transaction_id, receipt_id in chunk
+                    if receipt_id in receipts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-derive parsed receipts from stored raw e-receipts")
+    parser.add_argument('--db', default=DEFAULT_PATH, help="SQLite store path (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="worker processes (default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="receipts per task")
+    parser.add_argument('--report', help="write failures to JSON path")
+    args = parser.parse_args()
+
+    _start = time.perf_counter()
+    with Store(args.db) as _store:
+        _n_parsed, _failures = reparse(_store, workers=args.workers, chunk_size=args.chunk_size)
+    _elapsed = time.perf_counter() - _start
+    print(f"re-parsed {_n_parsed} receipts in {_elapsed:.1f}s ({_n_parsed / _elapsed:,.0f}/s); "
+          f"{len(_failures)} failed")
+    for _failure in _failures[:10]:
+        print(f"  {_failure['receipt_id']}: {_failure['error']}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(_failures, f, indent=2)
@@ -0,0 +1,347 @@
+"""
+Record & replay of Up & Woolies API responses; for offline load testing & reproducible end-to-end benchmarks.
+
+Recording: with `$UP_WOOLIES_RECORD` set to a directory, e.g. via `main.py --record DIR`, sessions from
+`utils.new_session` append each successful JSON response to `DIR/recording.ndjson`. Request headers are not kept & API
+tokens are redacted from everything written.
+
+Replay: `python replay.py DIR` serves a recording locally under both APIs' paths, with configurable latency, page sizes
+& 429 injection, & prints the environment that points the clients at it; e.g.
+
+    $ python replay.py recordings/ --latency 0.05 --rate-limit 0.01
+    $ UP_ENDPOINT=http://127.0.0.1:8080/api/v1/ WOOLIES_ENDPOINT=... python main.py --db /tmp/bench.sqlite3 --profile
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests import Response
+
+RECORDING_NAME = 'recording.ndjson'
+REDACTED = '<redacted>'
+REDACTED_VARIABLES = ['UP_TOKEN', 'WOOLIES_TOKEN']
+
+DEFAULT_UP_PAGE_SIZE = 10  # as per Up API when unspecified
+DEFAULT_FEED_PAGE_SIZE = 20
+
+Entry = Dict[str, Any]
+
+
+class Recorder:
+    """ Appends successful JSON responses of a session to a recording; thread-safe """
+
+    def __init__(self, directory: str):
+        self.path = Path(directory) / RECORDING_NAME
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def record(self, response: Response, *args, **kwargs):
+        """ Response hook for requests.Session """
+        if not response.ok:
+            return
+        try:
+            body = response.json()
+        except ValueError:
+            return
+        request = response.request
+        parts = urlsplit(response.url)
+        entry = {
+            'method': request.method,
+            'path': parts.path,
+            'query': parts.query,
+            'request': json.loads(request.body) if request.body else None,
+            'body': body,
+        }
+        line = _redact(json.dumps(entry))
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+@lru_cache(maxsize=None)
+def get_recorder(directory: str) -> Recorder:
+    """ Returns recorder shared by all sessions recording to directory """
+    return Recorder(directory)
+
+
+def _redact(text: str) -> str:
+    for variable in REDACTED_VARIABLES:
+        if token := os.getenv(variable):
+            text = text.replace(token, REDACTED)
+    return text
+
+
+class Recording:
+    """ Recorded responses, de-duplicated & grouped per API resource so that they can be re-paginated """
+
+    def __init__(self, entries: List[Entry]):
+        self.accounts: List[Dict[str, Any]] = []
+        self.up_transactions: Dict[str, Dict[str, Dict[str, Any]]] = {}  # path -> id -> resource
+        self.feed_items: Dict[str, Tuple[str, Dict[str, Any]]] = {}  # id -> (group title, item)
+        self.receipts: Dict[str, Dict[str, Any]] = {}  # receipt key -> response
+
+        for entry in entries:
+            path, body = entry['path'], entry['body']
+            if path.endswith('/accounts'):
+                self.accounts = body['data']
+            elif path.endswith('/transactions') and entry['method'] == 'GET':
+                resources = self.up_transactions.setdefault(path, {})
+                resources.update((resource['id'], resource) for resource in body['data'])
+            elif path.endswith('/graphql') and body.get('data'):
+                for group in body['data']['rtlRewardsActivityFeed']['list']['groups']:
+                    self.feed_items.update((item['id'], (group['title'], item)) for item in group['items'])
+            elif path.endswith('/ereceipts/transactions/details'):
+                self.receipts[entry['request']['receiptKey']] = body
+
+        # Restore newest-first order of both feeds, whatever order pages were recorded in
+        for path, resources in self.up_transactions.items():
+            self.up_transactions[path] = dict(sorted(
+                resources.items(), key=lambda item: datetime.fromisoformat(item[1]['attributes']['createdAt']),
+                reverse=True))
+        self._feed_order = sorted(self.feed_items, key=self._feed_date, reverse=True)
+
+    def _feed_date(self, item_id: str) -> datetime:
+        import woolies
+
+        group_title, item = self.feed_items[item_id]
+        return woolies.Transaction.from_response(item, group_title=group_title).date
+
+    @classmethod
+    def load(cls, directory: str) -> 'Recording':
+        with open(Path(directory) / RECORDING_NAME) as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(accounts={len(self.accounts)}, "
+                f"up_transactions={sum(map(len, self.up_transactions.values()))}, "
+                f"feed_items={len(self.feed_items)}, receipts={len(self.receipts)})")
+
+    def up_transaction(self, transaction_id: str) -> Optional[Dict[str, Any]]:
+        for resources in self.up_transactions.values():
+            if (resource := resources.get(transaction_id)) is not None:
+                return resource
+        return None
+
+    def up_page(self, path: str, params: Dict[str, str], page_size: int, base_url: str) -> Dict[str, Any]:
+        """ Returns page of Up transactions under path, filtered & paginated as per the Up API """
+        since, until = params.get('filter[since]'), params.get('filter[until]')
+        since, until = since and datetime.fromisoformat(since), until and datetime.fromisoformat(until)
+        category = params.get('filter[category]')
+
+        resources = []
+        for resource in self.up_transactions.get(path, {}).values():
+            created_at = datetime.fromisoformat(resource['attributes']['createdAt'])
+            if since is not None and created_at < since or until is not None and until <= created_at:
+                continue
+            if category is not None and (recorded := resource['relationships'].get('category')) is not None:
+                if (recorded['data'] or {}).get('id') != category:
+                    continue
+            resources.append(resource)
+
+        offset = int(params.get('page[after]', 0))
+        next_url = None
+        if offset + page_size < len(resources):
+            next_url = f"{base_url}{path}?{urlencode({**params, 'page[after]': offset + page_size})}"
+        return {'data': resources[offset:offset + page_size], 'links': {'prev': None, 'next': next_url}}
+
+    def feed_page(self, page_token: str, page_size: int, query: str = None) -> Dict[str, Any]:
+        """
+        Returns activity-feed page for page token, re-paginated to page_size items; with items pruned to the fields
+        selected by query, as the API would, if given.
+        """
+        offset = 0 if page_token == 'FIRST_PAGE' else int(page_token)
+        selection = _item_selection(query) if query is not None else None
+        groups = []
+        for item_id in self._feed_order[offset:offset + page_size]:
+            group_title, item = self.feed_items[item_id]
+            if not groups or groups[-1]['title'] != group_title:
+                groups.append({'__typename': 'RewardsActivityFeedGroup', 'id': group_title, 'title': group_title,
+                               'items': []})
+            groups[-1]['items'].append(_select(item, selection) if selection is not None else item)
+        next_page_token = str(offset + page_size) if offset + page_size < len(self._feed_order) else None
+        return {'data': {'rtlRewardsActivityFeed': {'list': {'groups': groups, 'nextPageToken': next_page_token}}}}
+
+
+@lru_cache(maxsize=None)
+def _item_selection(query: str) -> Optional[Dict[str, Any]]:
+    # Returns nested field names selected of the feed's items; or None if not found
+    from graphql import parse
+    from graphql.language import FieldNode
+
+    def find_items(selection_set) -> Optional[Dict[str, Any]]:
+        for node in selection_set.selections if selection_set is not None else []:
+            if isinstance(node, FieldNode) and node.name.value == 'items':
+                return fields(node.selection_set)
+            if (found := find_items(node.selection_set)) is not None:
+                return found
+        return None
+
+    def fields(selection_set) -> Dict[str, Any]:
+        return {node.name.value: fields(node.selection_set) if node.selection_set is not None else None
+                for node in selection_set.selections if isinstance(node, FieldNode)}
+
+    for definition in parse(query).definitions:
+        if (found := find_items(definition.selection_set)) is not None:
+            return found
+    return None
+
+
+def _select(value: Any, selection: Dict[str, Any]) -> Any:
+    if isinstance(value, list):
+        return [_select(element, selection) for element in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: _select(value[name], nested) if nested is not None and value.get(name) is not None
+            else value.get(name)
+            for name, nested in selection.items()}
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    Local stand-in for both APIs, serving a recording.
+
+    :param latency: seconds added to each response, plus up to `jitter` seconds at random.
+    :param up_page_size: overrides the page size requested by Up clients.
+    :param feed_page_size: items per activity-feed page.
+    :param rate_limit: probability of answering any request with 429 & `Retry-After: retry_after`.
+    """
+    daemon_threads = True
+
+    def __init__(self,
+                 recording: Recording,
+                 address: Tuple[str, int] = ('127.0.0.1', 0),
+                 latency: float = 0.,
+                 jitter: float = 0.,
+                 up_page_size: int = None,
+                 feed_page_size: int = DEFAULT_FEED_PAGE_SIZE,
+                 rate_limit: float = 0.,
+                 retry_after: int = 1,
+                 seed: int = None):
+        super().__init__(address, _ReplayHandler)
+        self.recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self.up_page_size = up_page_size
+        self.feed_page_size = feed_page_size
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environ(self) -> Dict[str, str]:
+        """ Returns environment variables pointing the clients at this server """
+        return {
+            'UP_ENDPOINT': f'{self.url}/api/v1/',
+            'WOOLIES_ENDPOINT': f'{self.url}/wx/',
+            'WOOLIES_GRAPHQL_ENDPOINT': f'{self.url}/wx/v1/bff/graphql',
+        }
+
+    def delay(self) -> Tuple[float, bool]:
+        """ Returns latency of next response & whether it's rate-limited """
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter), self._random.random() < self.rate_limit
+
+    def respond(self, method: str, path: str, params: Dict[str, str], body: Optional[Any]) -> Tuple[int, Any]:
+        """ Returns status & JSON payload of a request """
+        recording = self.recording
+        if method == 'GET' and path.endswith('/accounts'):
+            return 200, {'data': [self._local_links(account) for account in recording.accounts],
+                         'links': {'prev': None, 'next': None}}
+        if method == 'GET' and path.endswith('/transactions'):
+            page_size = self.up_page_size or int(params.get('page[size]', DEFAULT_UP_PAGE_SIZE))
+            return 200, recording.up_page(path, params, page_size, base_url=self.url)
+        if method == 'GET' and path.rpartition('/')[0].endswith('/transactions'):
+            if (resource := recording.up_transaction(path.rpartition('/')[2])) is None:
+                return 404, {'errors': [{'detail': f"no recorded transaction {path}"}]}
+            return 200, {'data': resource}
+        if method == 'POST' and path.endswith('/graphql'):
+            return 200, recording.feed_page(body['variables']['nextPageToken'], self.feed_page_size,
+                                            query=body.get('query'))
+        if method == 'POST' and path.endswith('/ereceipts/transactions/details'):
+            if (receipt := recording.receipts.get(body['receiptKey'])) is None:
+                return 404, {'errors': [{'detail': f"no recorded receipt {body['receiptKey']}"}]}
+            return 200, receipt
+        return 404, {'errors': [{'detail': f"nothing recorded for {method} {path}"}]}
+
+    def _local_links(self, account: Dict[str, Any]) -> Dict[str, Any]:
+        # Point account's transaction-url at this server
+        if (links := account.get('relationships', {}).get('transactions', {}).get('links')) is None:
+            return account
+        related = f"{self.url}{urlsplit(links['related']).path}"
+        return {**account, 'relationships': {**account['relationships'],
+                                             'transactions': {**account['relationships']['transactions'],
+                                                              'links': {**links, 'related': related}}}}
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as per the real APIs
+    server: ReplayServer
+
+    def do_GET(self):
+        self._serve()
+
+    def do_POST(self):
+        self._serve()
+
+    def _serve(self):
+        parts = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        latency, is_rate_limited = self.server.delay()
+        time.sleep(latency)
+        if is_rate_limited:
+            self._send(429, {'errors': [{'detail': 'rate limited'}]}, {'Retry-After': str(self.server.retry_after)})
+            return
+        status, payload = self.server.respond(self.command, parts.path, dict(parse_qsl(parts.query)),
+                                              json.loads(body) if body else None)
+        self._send(status, payload)
+
+    def _send(self, status: int, payload: Any, headers: Dict[str, str] = None):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve recorded Up & Woolies API responses locally")
+    parser.add_argument('directory', help="directory recorded to via $UP_WOOLIES_RECORD or main.py --record")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0., help="seconds added to each response")
+    parser.add_argument('--jitter', type=float, default=0., help="up to this many seconds added at random")
+    parser.add_argument('--up-page-size', type=int, help="override page size requested by Up clients")
+    parser.add_argument('--feed-page-size', type=int, default=DEFAULT_FEED_PAGE_SIZE)
+    parser.add_argument('--rate-limit', type=float, default=0., help="probability of answering with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds of injected 429s")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    _recording = Recording.load(args.directory)
+    server = ReplayServer(_recording, ('127.0.0.1', args.port), latency=args.latency, jitter=args.jitter,
+                          up_page_size=args.up_page_size, feed_page_size=args.feed_page_size,
+                          rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed)
+    print(f"replaying {_recording} on {server.url}; point clients at it with:")
+    print(' '.join(f'{name}={value}' for name, value in server.environ().items()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,173 @@
+"""
+Persistent inverted index over purchased item descriptions; kept in the local store's SQLite database.
+
+Descriptions are normalised before indexing; i.e. leading `#` markers are dropped, text is lower-cased & size suffixes
+are converted to base units, so that '#Cadbury Bar Twirl 39g' & 'Sanitarium Weet-Bix 1.2kg' index as
+['cadbury', 'bar', 'twirl', '39g'] & ['sanitarium', 'weet', 'bix', '1200g']. Each token maps to (transaction id, line).
+"""
+import argparse
+import re
+import sqlite3
+from decimal import Decimal
+from typing import Iterable, List, Set, Tuple
+
+import woolies
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_postings (
+    token TEXT NOT NULL,
+    transaction_id TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    PRIMARY KEY (token, transaction_id, line)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS search_documents (
+    transaction_id TEXT PRIMARY KEY
+);
+"""
+
+PATTERN_TOKEN = re.compile(r'\d+(?:\.\d+)?[a-z]*|[a-z]+')
+PATTERN_SIZE = re.compile(r'(\d+(?:\.\d+)?)(kg|g|ml|l|pk)')
+_BASE_UNITS = {'kg': ('g', 1000), 'g': ('g', 1), 'l': ('ml', 1000), 'ml': ('ml', 1), 'pk': ('pk', 1)}
+
+Posting = Tuple[str, int]  # (transaction id, line index)
+
+
+def normalise_size(token: str) -> str:
+    """ Returns size token in base units; e.g. '1.2kg' -> '1200g', '2l' -> '2000ml' """
+    if (match := PATTERN_SIZE.fullmatch(token)) is None:
+        return token
+    unit, scale = _BASE_UNITS[match.group(2)]
+    return f'{(Decimal(match.group(1)) * scale).normalize():f}{unit}'
+
+
+def tokenise(description: str) -> List[str]:
+    """ Returns normalised tokens of an item description """
+    return [normalise_size(token) for token in PATTERN_TOKEN.findall(description.lstrip('#').lower())]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """ Returns Levenshtein distance between a & b, or limit + 1 once it is exceeded """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex:
+    """ Inverted index of description tokens to (transaction id, line index) postings """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.connection.executescript(_SCHEMA)
+        self._vocabulary = None
+
+    def is_indexed(self, transaction_id: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM search_documents WHERE transaction_id = ?",
+                                       (transaction_id,)).fetchone() is not None
+
+    def add(self, transaction_id: str, receipt: woolies.ReceiptDetails):
+        """ Indexes receipt's items under transaction id; does nothing if already indexed """
+        with self.connection:
+            self._add(transaction_id, receipt)
+
+    def add_transactions(self, transactions: Iterable[woolies.Transaction]) -> int:
+        """ Indexes transactions with e-receipts not yet indexed, in one database transaction, & returns the count """
+        with self.connection:
+            return sum(self._add(transaction.id, transaction.receipt())
+                       for transaction in transactions
+                       if transaction.receiptId is not None and not self.is_indexed(transaction.id))
+
+    def reindex(self, documents: Iterable[Tuple[str, woolies.ReceiptDetails]]) -> int:
+        """
+        Replaces the whole index with (transaction id, receipt) documents & returns the count; within the caller's
+        database transaction, e.g. alongside re-parsed receipts, as postings are keyed by the line index of items.
+        """
+        self.connection.execute("DELETE FROM search_postings")
+        self.connection.execute("DELETE FROM search_documents")
+        self._vocabulary = None
+        return sum(self._add(transaction_id, receipt) for transaction_id, receipt in documents)
+
+    def _add(self, transaction_id: str, receipt: woolies.ReceiptDetails) -> bool:
+        if self.is_indexed(transaction_id):
+            return False
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO search_postings (token, transaction_id, line) VALUES (?, ?, ?)",
+            [(token, transaction_id, line)
+             for line, item in enumerate(receipt.items)
+             for token in set(tokenise(item.description))])
+        self.connection.execute("INSERT INTO search_documents (transaction_id) VALUES (?)", (transaction_id,))
+        self._vocabulary = None
+        return True
+
+    def vocabulary(self) -> List[str]:
+        if self._vocabulary is None:
+            self._vocabulary = [token for token, in self.connection.execute(
+                "SELECT DISTINCT token FROM search_postings ORDER BY token")]
+        return self._vocabulary
+
+    def expand(self, token: str, prefix: bool = False, fuzzy: int = 0) -> Set[str]:
+        """ Returns indexed tokens matching token exactly, by prefix, &/or within fuzzy edits """
+        if prefix:
+            matches = {match for match, in self.connection.execute(
+                "SELECT DISTINCT token FROM search_postings WHERE token >= ? AND token < ?",
+                (token, token + '\U0010ffff'))}
+        else:
+            matches = {token}
+        if fuzzy:
+            matches.update(candidate for candidate in self.vocabulary()
+                           if edit_distance(token, candidate, fuzzy) <= fuzzy)
+        return matches
+
+    def postings(self, tokens: Iterable[str]) -> Set[Posting]:
+        tokens = list(tokens)
+        if not tokens:
+            return set()
+        return set(self.connection.execute(
+            f"SELECT transaction_id, line FROM search_postings WHERE token IN ({','.join('?' * len(tokens))})",
+            tokens))
+
+    def query(self, text: str, prefix: bool = False, fuzzy: int = 0) -> List[Posting]:
+        """
+        Returns (transaction id, line index) of items whose descriptions match every token of text.
+
+        :param prefix: match tokens by prefix; e.g. 'choc' matches 'chocolate'.
+        :param fuzzy: maximum edit distance per token; e.g. 1 matches 'mulk' to 'milk'.
+        """
+        results = None
+        for token in tokenise(text):
+            postings = self.postings(self.expand(token, prefix=prefix, fuzzy=fuzzy))
+            results = postings if results is None else results & postings
+            if not results:
+                return []
+        return sorted(results or [])
+
+
+if __name__ == '__main__':
+    from rich import print
+
+    from store import DEFAULT_PATH, Store
+
+    parser = argparse.ArgumentParser(description="Search purchased items")
+    parser.add_argument('text')
+    parser.add_argument('--db', default=DEFAULT_PATH)
+    parser.add_argument('--prefix', action='store_true', help="match tokens by prefix")
+    parser.add_argument('--fuzzy', type=int, default=0, help="maximum edit distance per token")
+    args = parser.parse_args()
+
+    with Store(args.db) as _store:
+        _results = SearchIndex(_store.connection).query(args.text, prefix=args.prefix, fuzzy=args.fuzzy)
+        _transaction_ids = {transaction_id for transaction_id, _ in _results}
+        _transactions = {transaction.id: transaction for transaction in _store.woolies_transactions()
+                         if transaction.id in _transaction_ids}
+        _raw_receipts = _store.raw_receipts(transaction.receiptId for transaction in _transactions.values())
+        for _transaction_id, _line in _results:
+            _transaction = _transactions[_transaction_id]
+            _receipt = woolies.ReceiptDetails.from_raw(_raw_receipts[_transaction.receiptId])
+            print(_transaction.date, _transaction.origin, _receipt.items[_line])
@@ -0,0 +1,346 @@
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, Generator, Iterable, List, Optional, Set, Tuple
+
+import up
+import woolies
+from profiling import metrics
+from reconcile import UP_CATEGORY
+
+DEFAULT_PATH = os.getenv('UP_WOOLIES_DB', 'up_woolies.sqlite3')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS woolies_transactions (
+    id TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    receipt_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS woolies_transactions_date ON woolies_transactions (date);
+CREATE TABLE IF NOT EXISTS receipts (
+    receipt_id TEXT PRIMARY KEY,
+    raw TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parsed_receipts (
+    receipt_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS up_transactions (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS up_transactions_created_at ON up_transactions (created_at);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS matches (
+    woolies_transaction_id TEXT PRIMARY KEY,
+    up_transaction_id TEXT NOT NULL UNIQUE
+);
+"""
+
+
+class Store:
+    """
+    Local SQLite store of Woolies transactions, e-receipts & Up transactions for incremental syncing.
+
+    Woolies transactions are keyed by id, receipts by receiptId & Up transactions by id. Receipts never change once
+    issued, so they are cached forever. Each sync keeps a high-water mark & fetches only what is newer than the last.
+    Parsed receipts are kept alongside their raw responses & re-derived by `reparse.py` when the parsing rules change.
+
+    Progress is committed after each feed page, receipt & reconciliation, so a sync cut short, e.g. by the Woolies
+    token expiring, resumes where it stopped on the next run without re-fetching anything.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Sync state
+
+    def get_state(self, key: str) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_state(self, key: str, value: str):
+        self.connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+    def delete_state(self, *keys: str):
+        self.connection.executemany("DELETE FROM sync_state WHERE key = ?", [(key,) for key in keys])
+
+    # Woolies transactions
+
+    def has_woolies_transaction(self, transaction_id: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM woolies_transactions WHERE id = ?",
+                                       (transaction_id,)).fetchone() is not None
+
+    def add_woolies_transactions(self, transactions: Iterable[woolies.Transaction]):
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO woolies_transactions (id, date, receipt_id, data) VALUES (?, ?, ?, ?)",
+            [(transaction.id, transaction.date.isoformat(), transaction.receiptId,
+              transaction.json(exclude={'_receipt'})) for transaction in transactions])
+
+    def woolies_transactions(self, since: datetime = None, until: datetime = None) -> List[woolies.Transaction]:
+        """ Returns stored Woolies transactions, optionally bounded by date; newest first, like the activity feed """
+        rows = self.connection.execute("SELECT data FROM woolies_transactions WHERE date BETWEEN ? AND ? "
+                                       "ORDER BY date DESC, id DESC",
+                                       (_local_isoformat(since) if since is not None else datetime.min.isoformat(),
+                                        _local_isoformat(until) if until is not None else datetime.max.isoformat()))
+        return woolies.Transaction.parse_rows((data for data, in rows), trusted=True)
+
+    def sync_woolies(self, since: datetime = None) -> int:
+        """
+        Fetches Woolies transactions newer than the last sync, & `since` if given, then returns the number of new
+        transactions. N.B. the activity feed is ordered newest first, so paging stops at the first stored transaction;
+        unless `since` is older than the synced span, or None, in which case paging continues down to `since`.
+
+        Each page is committed with the token of the next page, so an interrupted walk is resumed from that token,
+        down to where it was headed, before new transactions are fetched.
+        """
+        n_new = 0
+        if (page_token := self.get_state('woolies_resume_token')) is not None:
+            n_new += self._walk_woolies(page_token, stop_id=self.get_state('woolies_resume_stop_id') or None,
+                                        since=since)
+        stop_id = self.get_state('woolies_high_water_mark') if self._is_woolies_synced(since) else None
+        n_new += self._walk_woolies(woolies.FIRST_PAGE_TOKEN, stop_id=stop_id, since=since)
+        return n_new
+
+    def _is_woolies_synced(self, since: Optional[datetime]) -> bool:
+        # Whether the stored feed spans back to since; the low-water mark is '' once the whole feed is stored
+        low_water_mark = self.get_state('woolies_low_water_mark')
+        if low_water_mark is None:
+            return False
+        return low_water_mark == '' or since is not None and _local_isoformat(since) >= low_water_mark
+
+    def _walk_woolies(self, page_token: str, stop_id: Optional[str], since: Optional[datetime]) -> int:
+        # Stores pages from page_token until stop_id, or any stored transaction when starting from the first page.
+        # Without a stop_id, stored transactions are walked past down to since, which then becomes the low-water mark
+        is_head = page_token == woolies.FIRST_PAGE_TOKEN
+        is_high_water_mark_set = False
+        n_new = 0
+        for transactions, next_page_token in woolies.Transaction.list_pages(since=since, page_token=page_token):
+            new_transactions = []
+            for transaction in transactions:
+                if stop_id is not None and (transaction.id == stop_id
+                                            or is_head and self.has_woolies_transaction(transaction.id)):
+                    next_page_token = None
+                    break
+                new_transactions.append(transaction)
+
+            with self.connection:
+                self.add_woolies_transactions(new_transactions)
+                if is_head and transactions and not is_high_water_mark_set:
+                    self.set_state('woolies_high_water_mark', transactions[0].id)
+                    is_high_water_mark_set = True
+                if next_page_token is not None:
+                    self.set_state('woolies_resume_token', next_page_token)
+                    if is_head:
+                        self.set_state('woolies_resume_stop_id', stop_id or '')
+                else:
+                    self.delete_state('woolies_resume_token', 'woolies_resume_stop_id')
+                    if stop_id is None:
+                        self._lower_woolies_low_water_mark(since)
+            n_new += len(new_transactions)
+            if next_page_token is None:
+                break
+        return n_new
+
+    def _lower_woolies_low_water_mark(self, since: Optional[datetime]):
+        low_water_mark = self.get_state('woolies_low_water_mark')
+        since = _local_isoformat(since) if since is not None else ''
+        if low_water_mark is None or low_water_mark != '' and (since == '' or since < low_water_mark):
+            self.set_state('woolies_low_water_mark', since)
+
+    # Receipts
+
+    def raw_receipts(self, receipt_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        receipt_ids = list(receipt_ids)
+        raw_receipts = {}
+        for i in range(0, len(receipt_ids), 500):  # stay below SQLite's host-parameter limit
+            chunk = receipt_ids[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT receipt_id, raw FROM receipts WHERE receipt_id IN ({','.join('?' * len(chunk))})", chunk)
+            raw_receipts.update((receipt_id, json.loads(raw)) for receipt_id, raw in rows)
+        return raw_receipts
+
+    def add_raw_receipts(self, raw_receipts: Dict[str, Dict[str, Any]]):
+        self.connection.executemany("INSERT OR IGNORE INTO receipts (receipt_id, raw) VALUES (?, ?)",
+                                    [(receipt_id, json.dumps(raw)) for receipt_id, raw in raw_receipts.items()])
+
+    def iter_raw_receipt_rows(self, chunk_size: int) -> Generator[List[Tuple[str, str]], None, None]:
+        """ Yields chunks of (receipt id, undecoded raw receipt) rows of every stored receipt """
+        cursor = self.connection.execute("SELECT receipt_id, raw FROM receipts ORDER BY receipt_id")
+        while rows := cursor.fetchmany(chunk_size):
+            yield rows
+
+    def parsed_receipts(self, receipt_ids: Iterable[str]) -> Dict[str, woolies.ReceiptDetails]:
+        receipt_ids = list(receipt_ids)
+        receipts = {}
+        for i in range(0, len(receipt_ids), 500):  # stay below SQLite's host-parameter limit
+            chunk = receipt_ids[i:i + 500]
+            rows = self.connection.execute(
+                f"SELECT receipt_id, data FROM parsed_receipts WHERE receipt_id IN ({','.join('?' * len(chunk))})",
+                chunk)
+            receipts.update((receipt_id, decode_receipt(data)) for receipt_id, data in rows)
+        return receipts
+
+    def add_parsed_receipts(self, receipts: Dict[str, woolies.ReceiptDetails]):
+        self.add_encoded_receipts((receipt_id, encode_receipt(receipt)) for receipt_id, receipt in receipts.items())
+
+    def add_encoded_receipts(self, rows: Iterable[Tuple[str, str]]):
+        """ Stores (receipt id, `encode_receipt`) rows; replacing receipts parsed before """
+        self.connection.executemany("INSERT OR REPLACE INTO parsed_receipts (receipt_id, data) VALUES (?, ?)", rows)
+
+    def sync_receipts(self, transactions: Iterable[woolies.Transaction]) -> int:
+        """
+        Fills each transaction's receipt cache from the store, fetching only receipts not yet stored, & returns the
+        number of receipts fetched. Each receipt is committed as it arrives; receipts are parsed once & stored parsed.
+        """
+        transactions = [transaction for transaction in transactions if transaction.receiptId is not None]
+        receipt_ids = list(dict.fromkeys(transaction.receiptId for transaction in transactions))
+        receipts = self.parsed_receipts(receipt_ids)
+        raw_receipts = self.raw_receipts(receipt_id for receipt_id in receipt_ids if receipt_id not in receipts)
+        missing = [receipt_id for receipt_id in receipt_ids
+                   if receipt_id not in receipts and receipt_id not in raw_receipts]
+        for receipt_id, raw in woolies.iter_raw_receipts(missing):
+            with self.connection:
+                self.add_raw_receipts({receipt_id: raw})
+            raw_receipts[receipt_id] = raw
+
+        with metrics.stage('woolies from_raw'):
+            parsed = {receipt_id: woolies.ReceiptDetails.from_raw(raw) for receipt_id, raw in raw_receipts.items()}
+        with self.connection:
+            self.add_parsed_receipts(parsed)
+        receipts.update(parsed)
+        for transaction in transactions:
+            transaction.set_receipt(receipts[transaction.receiptId])
+        return len(missing)
+
+    # Up transactions
+
+    def add_up_transactions(self, transactions: Iterable[up.Transaction]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO up_transactions (id, created_at, data) VALUES (?, ?, ?)",
+            [(str(transaction.id), _utc_isoformat(transaction.createdAt), transaction.json())
+             for transaction in transactions if transaction.createdAt is not None])
+
+    def up_transactions(self, since: datetime, until: datetime) -> List[up.Transaction]:
+        rows = self.connection.execute("SELECT data FROM up_transactions WHERE created_at BETWEEN ? AND ? "
+                                       "ORDER BY created_at DESC", (_utc_isoformat(since), _utc_isoformat(until)))
+        return up.Transaction.parse_rows((data for data, in rows), trusted=True)
+
+    def sync_up(self, since: datetime, until: datetime) -> List[up.Transaction]:
+        """
+        Returns stored Up grocery transactions within date span, after fetching the parts of the span not yet synced.
+        The synced span is kept as a low & high-water mark, so repeat syncs fetch only transactions since the last.
+        N.B. the span is only fetched up to now; a future `until` is left to be synced once it has passed.
+        """
+        since, until = since.astimezone(), until.astimezone()
+        fetch_until = min(until, datetime.now().astimezone())
+        low_water_mark = self.get_state('up_low_water_mark')
+        high_water_mark = self.get_state('up_high_water_mark')
+
+        spans = []  # (since, until, water marks advanced once fetched)
+        if low_water_mark is None or high_water_mark is None:
+            if since < fetch_until:
+                spans.append((since, fetch_until, {'up_low_water_mark': since, 'up_high_water_mark': fetch_until}))
+        else:
+            low_water_mark = datetime.fromisoformat(low_water_mark)
+            high_water_mark = datetime.fromisoformat(high_water_mark)
+            if since < low_water_mark:
+                spans.append((since, low_water_mark, {'up_low_water_mark': since}))
+            if fetch_until > high_water_mark:
+                spans.append((high_water_mark, fetch_until, {'up_high_water_mark': fetch_until}))
+
+        accounts = up.AllSpendingAccounts() if spans else None
+        for span_since, span_until, water_marks in spans:
+            transactions = [transaction
+                            for transactions in accounts.get_transactions(since=span_since,
+                                                                          until=span_until,
+                                                                          category=UP_CATEGORY,
+                                                                          prefetch=up.BULK_PREFETCH)
+                            for transaction in transactions]
+            with self.connection:
+                self.add_up_transactions(transactions)
+                for key, water_mark in water_marks.items():
+                    self.set_state(key, water_mark.isoformat())
+
+        return self.up_transactions(since, until)
+
+    # Matches
+
+    def add_matches(self, matched: Iterable[Tuple[woolies.Transaction, up.Transaction]]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO matches (woolies_transaction_id, up_transaction_id) VALUES (?, ?)",
+            [(woolies_transaction.id, str(up_transaction.id)) for woolies_transaction, up_transaction in matched])
+
+    def matched(self, woolies_transactions: Iterable[woolies.Transaction]
+                ) -> List[Tuple[woolies.Transaction, up.Transaction]]:
+        """ Returns stored matches of given Woolies transactions with their Up transactions; in the given order """
+        matched = []
+        for woolies_transaction in woolies_transactions:
+            row = self.connection.execute("SELECT data FROM matches JOIN up_transactions ON up_transaction_id = id "
+                                          "WHERE woolies_transaction_id = ?", (woolies_transaction.id,)).fetchone()
+            if row is not None:
+                matched.append((woolies_transaction, *up.Transaction.parse_rows(row, trusted=True)))
+        return matched
+
+    def matched_up_transaction_ids(self) -> Set[str]:
+        return {up_transaction_id for up_transaction_id, in self.connection.execute(
+            "SELECT up_transaction_id FROM matches")}
+
+
+def encode_receipt(receipt: woolies.ReceiptDetails) -> str:
+    """ Returns parsed receipt as JSON; unlike `.json()`, amounts are kept exact & `value` is included """
+    return json.dumps({**receipt.dict(), 'value': receipt.value}, default=_encode_default)
+
+
+def decode_receipt(data: str) -> woolies.ReceiptDetails:
+    """ Returns parsed receipt from `encode_receipt` JSON; constructed without revalidation, as stored once valid """
+    fields = json.loads(data)
+    return woolies.ReceiptDetails.construct(
+        items=[woolies.PurchaseItem.construct(**{**item,
+                                                 'amount': Decimal(item['amount']),
+                                                 'weight': _decimal(item['weight'])})
+               for item in fields['items']],
+        value=Decimal(fields['value']),
+        amount_paid=Decimal(fields['amount_paid']),
+        date=datetime.fromisoformat(fields['date']) if fields['date'] is not None else None,
+    )
+
+
+def _decimal(value: Optional[str]) -> Optional[Decimal]:
+    return Decimal(value) if value is not None else None
+
+
+def _encode_default(value: Any) -> str:
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"can't encode {type(value).__name__}")
+
+
+def _local_isoformat(date: datetime) -> str:
+    """ Returns sortable ISO-format string in naive local-time, as per Woolies' transaction dates """
+    return date.astimezone().replace(tzinfo=None).isoformat() if date.tzinfo is not None else date.isoformat()
+
+
+def _utc_isoformat(date: datetime) -> str:
+    """ Returns sortable ISO-format string in UTC; naive datetimes are assumed local """
+    return date.astimezone(timezone.utc).isoformat()
@@ -0,0 +1,147 @@
+"""
+Synthetic Woolies e-receipts for benchmarking; shaped like the data response of `ReceiptDetails.get_raw_receipt`.
+
+Receipts mix the edge patterns handled by `ReceiptDetails.from_raw`; i.e. multiple identical items with discounts,
+weighted goods, price-reduced lines & stand-alone discounts. Pages of Woolies activity-feed items & Up transactions
+are shaped like `Transaction.list_raw_pages` pages & Up's `data` resources respectively.
+"""
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, List
+
+RECEIPT_SIZES = {
+    'small': 5,
+    'typical': 30,
+    'bulk': 320,
+}
+
+_DESCRIPTIONS = [
+    'WW Whole Milk 2L', 'Abbotts Vil Bakery Country Grains 800g', '#Cadbury Bar Twirl 39g', 'Sanitarium Weet-Bix 1.2kg',
+    'WW Free Range Eggs 12pk 700g', 'Coca-Cola Classic Soft Drink Bottle 1.25L', 'Arnotts Tim Tam Original 200g',
+    'Helga\'s Wholemeal Bread 750g', '#Pauls Farmhouse Gold Milk 1.5L', 'Birds Eye Steam Fresh Peas 450g',
+]
+_WEIGHED_DESCRIPTIONS = ['Tomato Truss Red', 'Banana Cavendish', 'Kalamata Olives Pitted', 'Royal Gala Apple']
+_PARTNERS = [('unknown_partner', 'supermarkets_division_logo.png'), ('bws', 'bws_logo.png'), ('eg', 'eg_logo.png')]
+_STORES = ['Blackburn North', 'Doncaster Shopping Town', 'Box Hill Central', 'Camberwell']
+
+
+def _money(value: Decimal) -> str:
+    return f'{value:.2f}'
+
+
+def receipt(n_lines: int, rng: random.Random = None) -> Dict[str, Any]:
+    """ Returns a synthetic raw e-receipt of roughly n_lines item lines """
+    rng = rng or random.Random()
+    items: List[Dict[str, str]] = []
+    total = Decimal(0)
+    while len(items) < n_lines:
+        kind = rng.choices(['single', 'multiple', 'weighted', 'price_reduced', 'discount'], [60, 15, 12, 8, 5])[0]
+        unit_price = Decimal(rng.randint(50, 1500)) / 100
+        if kind == 'single':
+            items.append({'description': rng.choice(_DESCRIPTIONS), 'amount': _money(unit_price)})
+            total += unit_price
+        elif kind == 'multiple':
+            quantity = rng.randint(2, 6)
+            amount = unit_price * quantity
+            items.append({'description': rng.choice(_DESCRIPTIONS), 'amount': ''})
+            items.append({'description': f'Qty {quantity} @ ${_money(unit_price)} each', 'amount': _money(amount)})
+            total += amount
+            if rng.random() < 0.3:  # multi-buy discount
+                discount = -min(amount - Decimal('0.01'), Decimal(rng.randint(10, 200)) / 100)
+                items.append({'description': 'Multi-buy Discount', 'amount': _money(discount)})
+                total += discount
+        elif kind == 'weighted':
+            weight = Decimal(rng.randint(50, 2500)) / 1000
+            amount = max((unit_price * weight).quantize(Decimal('0.01')), Decimal('0.01'))
+            items.append({'description': rng.choice(_WEIGHED_DESCRIPTIONS), 'amount': ''})
+            items.append({'description': f'{weight:.3f} kg NET @ ${_money(unit_price)}/kg', 'amount': _money(amount)})
+            total += amount
+        elif kind == 'price_reduced':
+            items.append({'description': f'PRICE REDUCED BY ${_money(unit_price / 4)} each', 'amount': ''})
+        elif kind == 'discount' and items and items[-1]['amount'] not in ('', '-'):
+            discount = -Decimal(rng.randint(10, 100)) / 100
+            items.append({'description': 'Everyday Rewards Discount', 'amount': _money(discount)})
+            total += discount
+
+    date = datetime(2022, 1, 1) + timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+    payments = [{'description': 'X-1234', 'amount': _money(total)}]
+    if rng.random() < 0.1:  # partially paid by gift-card
+        gift_card = min(total, Decimal(rng.randint(100, 2000)) / 100)
+        payments = [{'description': 'Gift Card', 'amount': _money(gift_card)},
+                    {'description': 'EFT', 'amount': _money(total - gift_card)}]
+
+    return {'receiptDetails': {'details': [
+        {'__typename': 'ReceiptDetailsHeader', 'header': 'Woolworths Blackburn North'},
+        {'__typename': 'ReceiptDetailsItems', 'items': items},
+        {'__typename': 'ReceiptDetailsTotal', 'total': f'${_money(total)}'},
+        {'__typename': 'ReceiptDetailsPayments', 'payments': payments},
+        {'__typename': 'ReceiptDetailsFooter',
+         'transactionDetails': f'STORE 3060  POS  012  TRANS  {rng.randint(0, 9999):04}   {date:%H:%M  %d/%m/%Y}'},
+    ]}}
+
+
+def corpus(count: int, size: str = 'typical', seed: int = 0) -> List[Dict[str, Any]]:
+    """ Returns count synthetic raw e-receipts of given size; reproducible by seed """
+    rng = random.Random(seed)
+    return [receipt(RECEIPT_SIZES[size], rng) for _ in range(count)]
+
+
+def feed_page(n_items: int, seed: int = 0) -> Dict[str, Any]:
+    """ Returns a synthetic activity-feed page of n_items, newest first; mixing each form of transaction id """
+    rng = random.Random(seed)
+    date = datetime(2022, 10, 29, tzinfo=timezone.utc)
+    groups: List[Dict[str, Any]] = []
+    for i in range(n_items):
+        date -= timedelta(minutes=rng.randint(30, 60 * 24))
+        title = f'{date:%B %Y}'
+        if not groups or groups[-1]['title'] != title:
+            groups.append({'id': title, 'title': title, 'items': []})
+        icon, icon_url = rng.choice(_PARTNERS)
+        amount = _money(Decimal(rng.randint(100, 30000)) / 100)
+        if rng.random() < 0.5:
+            store_id = f'S{rng.randint(1000, 9999)}W{rng.randint(100, 999)}SN{i % 10000:04}'
+            transaction_id = f'{store_id}T{int(date.timestamp())}'
+        else:
+            transaction_id = f'{date:%Y%m%d%H%M%S%f}{rng.randint(0, 999999):06}'
+        groups[-1]['items'].append({
+            'id': transaction_id,
+            'displayDate': f'{date:%a %d %b}',
+            'description': f'${amount} at {(store := rng.choice(_STORES))}',
+            'displayValue': f'+ {rng.randint(0, 300)} pts',
+            'icon': icon,
+            'iconUrl': f'https://static.woolworthsrewards.com.au/icons/{icon_url}',
+            'transactionType': 'purchase',
+            'transaction': {'origin': store, 'amountAsDollars': f'${amount}'},
+            'receipt': {'receiptId': f'{rng.getrandbits(64):016x}'} if icon == 'unknown_partner' else None,
+        })
+    return {'rtlRewardsActivityFeed': {'list': {'groups': groups, 'nextPageToken': None}}}
+
+
+def up_page(n_items: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """ Returns n_items synthetic Up transaction resources, newest first """
+    rng = random.Random(seed)
+    date = datetime(2022, 10, 29, tzinfo=timezone(timedelta(hours=11)))
+    resources = []
+    for _ in range(n_items):
+        date -= timedelta(minutes=rng.randint(30, 60 * 24))
+        amount = Decimal(rng.randint(100, 30000)) / 100
+        resources.append({
+            'type': 'transactions',
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'attributes': {
+                'status': 'SETTLED',
+                'rawText': 'WOOLWORTHS 3060 BLACKBURN',
+                'description': 'Woolworths',
+                'message': None,
+                'amount': {'currencyCode': 'AUD',
+                           'value': f'-{_money(amount)}',
+                           'valueInBaseUnits': f'-{amount * 100:.0f}'},
+                'foreignAmount': None,
+                'settledAt': (date + timedelta(days=1)).isoformat(),
+                'createdAt': date.isoformat(),
+            },
+            'relationships': {'account': {'data': {'type': 'accounts', 'id': 'account'}}},
+        })
+    return resources
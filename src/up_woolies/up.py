@@ -1,29 +1,56 @@
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
 from datetime import datetime
 from decimal import Decimal
-from typing import Dict, List, Generator, Any, Literal, Optional
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Generator, Any, Iterable, Literal, Optional, Set
 from urllib.parse import urljoin
+from uuid import UUID
 
-import prance
+import requests
 from dotenv import find_dotenv, load_dotenv
 from pydantic import BaseModel, Extra, UUID4
 
-from utils import new_session, parse_money
+from profiling import metrics
+from utils import buffered, new_session, parse_money
 
-# Get token from environment variables
-load_dotenv(dotenv_path=find_dotenv())
+# Define endpoint; overridable, e.g. to replay recorded responses
+endpoint = os.getenv('UP_ENDPOINT', "https://api.up.com.au/api/v1/")
 
-# Define endpoint & headers
-endpoint = "https://api.up.com.au/api/v1/"
-session = new_session()
-session.headers.update({
-    "Authorization": f"Bearer {os.environ['UP_TOKEN']}"
-})
+SPEC_URL = "https://raw.githubusercontent.com/up-banking/api/master/v1/openapi.json"
+SPEC_CACHE_PATH = Path(os.getenv('XDG_CACHE_HOME', Path.home() / '.cache')) / 'up_woolies' / 'up_openapi.json'
 
-parser = prance.ResolvingParser("https://raw.githubusercontent.com/up-banking/api/master/v1/openapi.json")
+ACCOUNT_CACHE_TTL = 60 * 60  # seconds; accounts are rarely opened or closed
+ACCOUNT_CACHE_PATH = os.getenv('UP_WOOLIES_ACCOUNT_CACHE')  # opt-in disk persistence of account metadata
 
 
-# print(parser.specification)  # contains fully resolved specs as a dict
+@lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """ Returns shared session with authorisation headers; created on first use """
+    # Get token from environment variables
+    load_dotenv(dotenv_path=find_dotenv())
+
+    session = new_session()
+    session.headers.update({
+        "Authorization": f"Bearer {os.environ['UP_TOKEN']}"
+    })
+    return session
+
+
+def load_spec(refresh: bool = False) -> Dict[str, Any]:
+    """ Returns fully resolved Up OpenAPI spec; resolved once & then loaded from a local cached copy """
+    if refresh or not SPEC_CACHE_PATH.exists():
+        import prance
+
+        parser = prance.ResolvingParser(SPEC_URL)
+        SPEC_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        SPEC_CACHE_PATH.write_text(json.dumps(parser.specification))
+    return json.loads(SPEC_CACHE_PATH.read_text())
 
 
 class Transaction(BaseModel, extra=Extra.allow):
@@ -49,14 +76,57 @@ class Transaction(BaseModel, extra=Extra.allow):
 
     @classmethod
     def from_response(cls, response: Dict[str, Any]):
-        return cls(id=response['id'], **response['attributes'])
+        return cls(id=response['id'], **_parse_datetimes(response['attributes']))
+
+    @classmethod
+    def from_page(cls,
+                  resources: Iterable[Dict[str, Any]],
+                  account_ids: Set[str] = None,
+                  trusted: bool = False) -> List['Transaction']:
+        """
+        Returns transactions of a page of resources; optionally of given accounts only.
+
+        :param trusted: skip validation; only for resources we've previously validated, e.g. from a recording.
+        """
+        construct = cls._construct if trusted else cls
+        return [construct(id=resource['id'], **_parse_datetimes(resource['attributes']))
+                for resource in resources
+                if account_ids is None or resource['relationships']['account']['data']['id'] in account_ids]
+
+    @classmethod
+    def parse_rows(cls, rows: Iterable[str], trusted: bool = False) -> List['Transaction']:
+        """
+        Returns transactions from their JSON serialisations; e.g. rows of a local store.
+
+        :param trusted: skip validation; only for JSON serialised by `.json()` of already validated transactions.
+        """
+        if not trusted:
+            return [cls.parse_raw(row) for row in rows]
+        return [cls._construct(**_parse_datetimes(json.loads(row))) for row in rows]
+
+    @classmethod
+    def _construct(cls, **fields) -> 'Transaction':
+        # As per validation, but cheaper; i.e. for trusted input
+        fields['id'] = UUID(str(fields['id']))
+        for key in ('amount', 'foreignAmount'):
+            if isinstance(money := fields.get(key), dict):
+                fields[key] = cls.MoneyObject.construct(**money)
+        return cls.construct(**fields)
 
     @property
     def value(self) -> Decimal:
         return parse_money(self.amount.value)
 
 
+def _parse_datetimes(attributes: Dict[str, Any]) -> Dict[str, Any]:
+    # ISO 8601 datetimes, as given by Up, parse far cheaper than by validation
+    return {**attributes, **{key: datetime.fromisoformat(attributes[key])
+                             for key in ('settledAt', 'createdAt') if isinstance(attributes.get(key), str)}}
+
+
 DEFAULT_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 100
+BULK_PREFETCH = 2  # read-ahead depth for long history scans
 
 
 class Account:
@@ -66,41 +136,30 @@ class Account:
                  display_name: str,
                  account_type: Literal['TRANSACTIONAL', 'SAVER'] = None,
                  ownership_type: Literal['INDIVIDUAL', 'JOINT'] = None):
-        attributes = {k: v for k, v in {
-            'displayName': display_name,
-            'accountType': account_type,
-            'ownershipType': ownership_type,
-        }.items() if v is not None}
-
-        # Find account details by name
-        for account in list_accounts():
-            if attributes.items() <= account['attributes'].items():
-                break
-        else:
-            raise ValueError(f"could not find account matching {attributes=}")
-
+        account = find_account(get_account_registry().accounts(),
+                               display_name=display_name,
+                               account_type=account_type,
+                               ownership_type=ownership_type)
         self.account = account
         self.transaction_url = account['relationships']['transactions']['links']['related']
 
     def get_transactions(self,
-                         page_size: int = DEFAULT_PAGE_SIZE,
+                         page_size: int = None,
                          since: datetime = None,
                          until: datetime = None,
-                         category: str = None) -> Generator[List[Transaction], None, None]:
-        """ Yields list of transactions based off input filters """
-        response = session.get(url=self.transaction_url,
-                               params={
-                                   'page[size]': page_size,
-                                   'filter[since]': since.astimezone().isoformat('T') if since is not None else since,
-                                   'filter[until]': until.astimezone().isoformat('T') if until is not None else until,
-                                   'filter[category]': category
-                               }).json()
-        yield [Transaction.from_response(transaction) for transaction in response['data']]
-
-        # Continue with pagination link
-        while (url := response['links']['next']) is not None:
-            response = session.get(url=url).json()
-            yield [Transaction.from_response(transaction) for transaction in response['data']]
+                         category: str = None,
+                         prefetch: int = 0) -> Generator[List[Transaction], None, None]:
+        """
+        Yields list of transactions based off input filters.
+
+        :param page_size: defaults to the API maximum when prefetching, otherwise `DEFAULT_PAGE_SIZE`.
+        :param prefetch: number of pages to read-ahead in the background while the current page is consumed.
+        """
+        params = transaction_params(_page_size(page_size, prefetch), since, until, category)
+        for response in paginate(self.transaction_url, params, prefetch=prefetch):
+            with metrics.stage('up from_response'):
+                transactions = Transaction.from_page(response['data'])
+            yield transactions
 
 
 class SpendingAccount(Account):
@@ -117,46 +176,187 @@ class AllSpendingAccounts:
     """ Class for managing multiple transactional accounts; i.e. individual & joint accounts. """
 
     def __init__(self):
-        self._accounts = [account for account in list_accounts()
+        self._accounts = [account for account in get_account_registry().accounts()
                           if account['attributes']['accountType'] == 'TRANSACTIONAL']
-        self._account_ids = [account['id'] for account in self._accounts]
+        self._account_ids = {account['id'] for account in self._accounts}
 
     def get_transactions(self,
-                         page_size: int = DEFAULT_PAGE_SIZE,
+                         page_size: int = None,
                          since: datetime = None,
                          until: datetime = None,
-                         category: str = None) -> Generator[List[Transaction], None, None]:
+                         category: str = None,
+                         prefetch: int = 0) -> Generator[List[Transaction], None, None]:
         """
-        Yields list of transactions based off input filters.
+        Yields list of transactions based off input filters; see `Account.get_transactions` for parameters.
 
         Note: this method gets from all accounts & then filters down, unlike the base `Account` class which requests
         from the accounts transaction-url. Preliminary tests show this approach is faster than chaining individual
-        account generators & guarantees ordered transactions.
+        account generators & guarantees ordered transactions. With a single transactional account, its
+        transaction-url is requested instead; so no other account's transactions are paged through.
         """
-        response = session.get(url=urljoin(endpoint, 'transactions'),
-                               params={
-                                   'page[size]': page_size,
-                                   'filter[since]': since.astimezone().isoformat('T') if since is not None else since,
-                                   'filter[until]': until.astimezone().isoformat('T') if until is not None else until,
-                                   'filter[category]': category
-                               }).json()
-        yield [Transaction.from_response(transaction)
-               for transaction in response['data']
-               if transaction['relationships']['account']['data']['id'] in self._account_ids]
-
-        # Continue with pagination link
-        while (url := response['links']['next']) is not None:
-            response = session.get(url=url).json()
-            yield [Transaction.from_response(transaction)
-                   for transaction in response['data']
-                   if transaction['relationships']['account']['data']['id'] in self._account_ids]
+        params = transaction_params(_page_size(page_size, prefetch), since, until, category)
+        if len(self._accounts) == 1:
+            url = self._accounts[0]['relationships']['transactions']['links']['related']
+        else:
+            url = urljoin(endpoint, 'transactions')
+        for response in paginate(url, params, prefetch=prefetch):
+            with metrics.stage('up from_response'):
+                transactions = Transaction.from_page(response['data'], account_ids=self._account_ids)
+            yield transactions
 
 
 #
 
 
 def list_accounts() -> List[Dict[str, Any]]:
-    return session.get(url=urljoin(endpoint, 'accounts')).json()['data']
+    return get_session().get(url=urljoin(endpoint, 'accounts')).json()['data']
+
+
+class AccountRegistry:
+    """
+    TTL-cached account metadata, shared by account views so that building several costs one request.
+
+    :param path: optional JSON file to persist accounts to between runs; suffixed with a digest of each token.
+    """
+
+    def __init__(self, ttl: float = ACCOUNT_CACHE_TTL, path: str = None):
+        self.ttl = ttl
+        self.path = Path(path) if path is not None else None
+        self._accounts: Optional[List[Dict[str, Any]]] = None
+        self._fetched_at = 0.
+        self._lock = threading.RLock()
+
+    def accounts(self) -> List[Dict[str, Any]]:
+        """ Returns accounts; from the cache while fresh """
+        with self._lock:
+            if (accounts := self.cached()) is None:
+                accounts = self.store(list_accounts())
+            return accounts
+
+    def cached(self) -> Optional[List[Dict[str, Any]]]:
+        """ Returns accounts if cached in memory or on disk & fresh; otherwise None """
+        with self._lock:
+            if self._accounts is not None and not self._is_expired(self._fetched_at):
+                return self._accounts
+            return self._accounts if self._load() else None
+
+    def store(self, accounts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ Caches freshly requested accounts; e.g. by the asyncio client """
+        with self._lock:
+            self._accounts, self._fetched_at = accounts, time.time()
+            self._save()
+            return accounts
+
+    def invalidate(self):
+        with self._lock:
+            self._accounts = None
+            if self.path is not None:
+                self._token_path().unlink(missing_ok=True)
+
+    def _is_expired(self, fetched_at: float) -> bool:
+        return time.time() - fetched_at > self.ttl
+
+    def _token_path(self) -> Path:
+        # A file per token, so that tenants sharing the cache path don't evict each other
+        return self.path.with_name(f'{self.path.stem}-{_token_digest()[:16]}{self.path.suffix}')
+
+    def _load(self) -> bool:
+        if self.path is None:
+            return False
+        try:
+            cached = json.loads(self._token_path().read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if cached.get('token') != _token_digest() or self._is_expired(cached['fetched_at']):
+            return False
+        self._accounts, self._fetched_at = cached['accounts'], cached['fetched_at']
+        return True
+
+    def _save(self):
+        # Written to a temporary file & renamed over the cache, so that concurrent processes never read it half-written
+        if self.path is not None:
+            path = self._token_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'token': _token_digest(), 'fetched_at': self._fetched_at, 'accounts': self._accounts}, f)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+
+@lru_cache(maxsize=None)
+def get_account_registry() -> AccountRegistry:
+    """ Returns shared account registry; persisted to `$UP_WOOLIES_ACCOUNT_CACHE` if set """
+    return AccountRegistry(path=ACCOUNT_CACHE_PATH)
+
+
+def _token_digest() -> str:
+    # Identifies whose accounts are cached without storing the token itself
+    get_session()  # loads token from .env
+    return hashlib.sha256(os.environ['UP_TOKEN'].encode()).hexdigest()
+
+
+def get_transaction(transaction_id: str) -> Dict[str, Any]:
+    """ Returns raw transaction resource; i.e. with relationships such as its category """
+    return get_session().get(url=urljoin(endpoint, f'transactions/{transaction_id}')).json()['data']
+
+
+def find_account(accounts: List[Dict[str, Any]], *,
+                 display_name: str,
+                 account_type: Literal['TRANSACTIONAL', 'SAVER'] = None,
+                 ownership_type: Literal['INDIVIDUAL', 'JOINT'] = None) -> Dict[str, Any]:
+    """ Returns account details matching given attributes """
+    attributes = {k: v for k, v in {
+        'displayName': display_name,
+        'accountType': account_type,
+        'ownershipType': ownership_type,
+    }.items() if v is not None}
+
+    # Find account details by name
+    for account in accounts:
+        if attributes.items() <= account['attributes'].items():
+            return account
+    raise ValueError(f"could not find account matching {attributes=}")
+
+
+def _page_size(page_size: Optional[int], prefetch: int) -> int:
+    if page_size is not None:
+        return page_size
+    return MAX_PAGE_SIZE if prefetch else DEFAULT_PAGE_SIZE
+
+
+def paginate(url: str, params: Dict[str, Any] = None, prefetch: int = 0) -> Generator[Dict[str, Any], None, None]:
+    """
+    Yields decoded responses by following pagination links from url.
+
+    With prefetch, pages are fetched by a background thread into a queue bounded to that many pages; i.e. the next
+    page is requested while the current page is parsed & consumed, & memory stays capped by the read-ahead depth.
+    """
+    if prefetch:
+        yield from buffered(paginate(url, params), maxsize=prefetch, name='up-page-prefetch')
+        return
+
+    response = get_session().get(url=url, params=params).json()
+    yield response
+    while (url := response['links']['next']) is not None:
+        response = get_session().get(url=url).json()
+        yield response
+
+
+def transaction_params(page_size: int,
+                       since: Optional[datetime],
+                       until: Optional[datetime],
+                       category: Optional[str]) -> Dict[str, Any]:
+    """ Returns query parameters for transaction endpoints; unset filters are dropped """
+    return {k: v for k, v in {
+        'page[size]': page_size,
+        'filter[since]': since.astimezone().isoformat('T') if since is not None else since,
+        'filter[until]': until.astimezone().isoformat('T') if until is not None else until,
+        'filter[category]': category
+    }.items() if v is not None}
 
 
 if __name__ == '__main__':
@@ -164,7 +364,7 @@ if __name__ == '__main__':
 
     up_account = SpendingAccount()
     grocery_retailers = defaultdict(list)
-    for _transactions in up_account.get_transactions(page_size=100):
+    for _transactions in up_account.get_transactions(prefetch=BULK_PREFETCH):
         for trans in _transactions:
             if (desc := trans.description) in ['Coles', 'Woolworths']:
                 grocery_retailers[desc].append(trans)
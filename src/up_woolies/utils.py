@@ -1,11 +1,22 @@
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 from decimal import Decimal
 from re import sub
+from queue import Full, Queue
+from typing import Any, Dict, Generator, Iterable, Iterator, Literal, Mapping, Optional, TypeVar
+from urllib.parse import urlsplit
 
 import requests
 from requests import PreparedRequest, Response
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from profiling import metrics
+
+T = TypeVar('T')
+
 
 def parse_money(money_str: str) -> Decimal:
     return Decimal(sub(r'[^\d.]', '', money_str))
@@ -18,20 +29,415 @@ class DefaultTimeoutAdapter(HTTPAdapter):
 
     def send(self, request: PreparedRequest, **kwargs) -> Response:
         kwargs['timeout'] = kwargs.get('timeout') or self.timeout
-        return super().send(request, **kwargs)
+        if limits.rate_limiter is not None:
+            limits.rate_limiter.acquire()
+        hostname = urlsplit(request.url).hostname
+        if (controller := limits.controller(hostname)) is None:
+            with limits.host_semaphores.get(hostname) or nullcontext():
+                return super().send(request, **kwargs)
 
+        with controller.slot(), limits.host_semaphores.get(hostname) or nullcontext():
+            start = time.perf_counter()
+            try:
+                response = super().send(request, **kwargs)
+            except requests.RequestException:
+                controller.observe(None, None)
+                raise
+            # Latency only signals congestion when uninflated by retries' back-off
+            retry = getattr(response.raw, 'retries', None)
+            controller.observe(response.status_code, None if retry and retry.history else time.perf_counter() - start)
+            return response
 
-def new_session() -> requests.Session:
-    """ Return requests.Session with batteries included; i.e. timeout, retries, error-raising. """
-    session = requests.session()
-    retry_strategy = Retry(
-        total=3,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
-        method_whitelist=["HEAD", "GET", "OPTIONS"]
+
+class TokenBucket:
+    """ Thread-safe token-bucket rate limiter; permits `rate` acquisitions per second with bursts up to `capacity` """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """ Drains the bucket so that no token is available for given seconds; e.g. to honour `Retry-After` """
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+            self._updated_at = time.monotonic()
+
+
+_END = object()
+
+
+def buffered(iterable: Iterable[T], maxsize: int, name: str = None) -> Generator[T, None, None]:
+    """
+    Yields items of iterable, consumed ahead by a background thread into a queue bounded to maxsize items; i.e. a
+    pipeline stage that overlaps with its consumer, with backpressure once the consumer falls behind. Exceptions are
+    re-raised in the consumer, & the thread stops once the consumer closes the generator; closing iterable in turn,
+    so that closing the last of chained stages stops them all.
+    """
+    items: Queue = Queue(maxsize=maxsize)
+    is_closed = threading.Event()
+
+    def put(item) -> bool:
+        # Block on a full queue, but give up once the consumer has gone
+        while not is_closed.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    try:
+        while (item := items.get()) is not _END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        is_closed.set()
+
+
+class RequestLimits:
+    """
+    Process-wide limits on requests sent by `new_session` adapters; unlimited by default.
+
+    :ivar host_semaphores: semaphores bounding concurrent requests by hostname; may be shared between processes.
+    :ivar rate_limiter: token-bucket shared by all requests; e.g. per tenant.
+    :ivar adaptive: whether requests go through each host's `HostController`; i.e. adaptive concurrency & breaker.
+    """
+
+    def __init__(self):
+        self.host_semaphores: Dict[str, Any] = {}
+        self.rate_limiter: Optional[TokenBucket] = None
+        self.adaptive = True
+        self.controllers: Dict[str, HostController] = {}
+        self._lock = threading.Lock()
+
+    def controller(self, hostname: str) -> Optional['HostController']:
+        """ Returns hostname's shared controller, created on first use; or None if not adaptive """
+        if not self.adaptive:
+            return None
+        with self._lock:
+            if (controller := self.controllers.get(hostname)) is None:
+                controller = self.controllers[hostname] = HostController(hostname)
+            return controller
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            controllers = list(self.controllers.items())
+        return {hostname: controller.stats() for hostname, controller in controllers}
+
+
+limits = RequestLimits()
+metrics.register_source('hosts', limits.stats)
+
+
+def retry_after(response: Any, default: float = 1) -> float:
+    """ Returns seconds to wait as per response's `Retry-After` header; supports delay-seconds only """
+    try:
+        return max(float(response.headers['Retry-After']), 0)
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+# Shared HTTP configuration of both APIs, over REST & GraphQL alike
+DEFAULT_TIMEOUT = 5
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1
+DEFAULT_POOL_SIZE = int(os.getenv('UP_WOOLIES_POOL_SIZE', 10))  # keep-alive connections per host
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_METHODS = ["HEAD", "GET", "OPTIONS"]
+
+
+def backoff(attempt: int) -> float:
+    """ Returns seconds to wait before retrying after given failed attempt, counted from 0; as per urllib3's `Retry` """
+    return DEFAULT_BACKOFF_FACTOR * 2 ** attempt if attempt else 0
+
+
+def is_retryable_error(error: Exception, idempotent: bool) -> bool:
+    """
+    Returns whether an aiohttp request error is retried, as per urllib3's `Retry`; i.e. failures to connect, as the
+    request was never sent, & otherwise dropped connections or timeouts of idempotent requests only.
+    """
+    import asyncio
+
+    import aiohttp
+    if isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    return idempotent and isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+DEFAULT_LATENCY_TOLERANCE = 2.  # latency, as a multiple of the host's baseline, taken as congestion
+DEFAULT_FAILURE_THRESHOLD = 5  # consecutive failed requests that trip a host's circuit breaker
+DEFAULT_COOLDOWN = 30  # seconds a tripped circuit stays open before a probe request
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """ Raised instead of sending a request to a host whose circuit breaker has tripped """
+
+
+class HostController:
+    """
+    Adaptive concurrency limit & circuit breaker of an API host; shared by every session of the process.
+
+    The limit of in-flight requests grows by one per limit's worth of prompt responses & halves on 429s, 5xx,
+    connection errors or average latency beyond `latency_tolerance` times the host's baseline; at most once per
+    round-trip (AIMD). A `Retry-After` pauses every request to the host. After `failure_threshold` consecutive failed
+    requests the circuit opens & requests fail fast with `CircuitOpenError`; after `cooldown` seconds one probe request
+    is let through, which closes the circuit on success or re-opens it on failure.
+    """
+
+    def __init__(self,
+                 hostname: str,
+                 max_limit: int = DEFAULT_POOL_SIZE,
+                 min_limit: int = 1,
+                 latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+                 failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 cooldown: float = DEFAULT_COOLDOWN):
+        self.hostname = hostname
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_tolerance = latency_tolerance
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.state: Literal['closed', 'open', 'half-open'] = 'closed'
+        self.counters = {'requests': 0, 'failures': 0, 'throttled': 0, 'decreases': 0, 'trips': 0, 'rejected': 0}
+        self._baseline: Optional[float] = None  # slow-rising minimum latency
+        self._smoothed: Optional[float] = None  # moving average latency; i.e. round-trip
+        self._consecutive_failures = 0
+        self._decreased_at = 0.
+        self._paused_until = 0.
+        self._opened_at = 0.
+        self._is_probing = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """ Holds one of the host's in-flight slots; blocking while at the limit or paused """
+        is_probe = self.acquire()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                if is_probe:  # only on release, as requests in flight before the probe are observed meanwhile
+                    self._is_probing = False
+                self._condition.notify_all()
+
+    def acquire(self) -> bool:
+        """ Takes an in-flight slot & returns whether the request is the probe of a half-open circuit """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self.state == 'open':
+                    if now < self._opened_at + self.cooldown:
+                        self.counters['rejected'] += 1
+                        raise CircuitOpenError(f"circuit to {self.hostname} is open for another "
+                                               f"{self._opened_at + self.cooldown - now:.0f}s")
+                    self.state = 'half-open'
+                if now < self._paused_until:
+                    self._condition.wait(self._paused_until - now)
+                elif self.in_flight >= max(int(self.limit), self.min_limit) or self._is_probing:
+                    self._condition.wait(1)
+                else:
+                    self.in_flight += 1
+                    self._is_probing = self.state == 'half-open'
+                    return self._is_probing
+
+    def observe(self, status: Optional[int], latency: Optional[float]):
+        """
+        Adjusts limit & circuit for the outcome of a request.
+
+        :param status: final status; or None after a connection error.
+        :param latency: seconds; or None if not a congestion signal.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self.counters['requests'] += 1
+            if status is None or status == 429 or status >= 500:
+                self.counters['failures'] += 1
+                self._consecutive_failures += 1
+                self._decrease(now)
+                if self.state == 'half-open' or self._consecutive_failures >= self.failure_threshold:
+                    if self.state != 'open':
+                        self.counters['trips'] += 1
+                    self.state, self._opened_at = 'open', now
+            else:
+                self._consecutive_failures = 0
+                self.state = 'closed'
+                if latency is not None:
+                    self._baseline = latency if self._baseline is None else min(
+                        latency, self._baseline + (latency - self._baseline) * 0.01)
+                    self._smoothed = latency if self._smoothed is None else 0.8 * self._smoothed + 0.2 * latency
+                if latency is not None and self._smoothed > self._baseline * self.latency_tolerance:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._condition.notify_all()
+
+    def on_retry(self, status: Optional[int], retry_after: float = 0):
+        """ Adjusts limit for an attempt about to be retried, pausing the host for its `Retry-After` """
+        with self._condition:
+            now = time.monotonic()
+            if status == 429:
+                self.counters['throttled'] += 1
+            if status is None or status == 429 or status >= 500:
+                self._decrease(now)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def _decrease(self, now: float):
+        if now - self._decreased_at >= (self._smoothed or 0):
+            self.limit = max(self.limit / 2, self.min_limit)
+            self._decreased_at = now
+            self.counters['decreases'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'limit': max(int(self.limit), self.min_limit),
+                'in_flight': self.in_flight,
+                'state': self.state,
+                'paused_for': max(self._paused_until - time.monotonic(), 0.),
+                'latency_baseline': self._baseline,
+                **self.counters,
+            }
+
+
+class RateLimitRetry(Retry):
+    """ Retry strategy that also retries rate-limited requests, i.e. 429, of any method; as they were never served """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None) -> Retry:
+        # Let the host's controller react to each failed attempt, rather than only to the final outcome
+        if _pool is not None and (controller := limits.controller(_pool.host)) is not None:
+            controller.on_retry(response.status if response is not None else None,
+                                retry_after(response, default=0) if response is not None else 0)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def new_adapter(pool_size: int = DEFAULT_POOL_SIZE, methods: Iterable[str] = RETRY_METHODS) -> DefaultTimeoutAdapter:
+    """
+    Returns pooled adapter with the shared timeout & retry strategy; honouring `Retry-After`.
+
+    :param methods: methods retried on any error; e.g. plus POST for endpoints whose POSTs are idempotent queries.
+    """
+    retry_strategy = RateLimitRetry(
+        total=DEFAULT_RETRIES,
+        backoff_factor=DEFAULT_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        method_whitelist=list(methods)
     )
-    session.mount('https://', DefaultTimeoutAdapter(timeout=5, max_retries=retry_strategy))
+    return DefaultTimeoutAdapter(timeout=DEFAULT_TIMEOUT, max_retries=retry_strategy,
+                                 pool_connections=pool_size, pool_maxsize=pool_size)
+
+
+def new_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """
+    Return requests.Session with batteries included; i.e. timeout, retries, error-raising, instrumentation.
+
+    :param pool_size: keep-alive connections per host; size for the number of concurrent workers.
+    """
+    session = requests.session()
+    adapter = new_adapter(pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)  # e.g. local replay servers
     session.hooks = {
-        'response': lambda r, *args, **kwargs: r.raise_for_status()
+        'response': [metrics.observe_response]
     }
+    if record_directory := os.getenv('UP_WOOLIES_RECORD'):
+        from replay import get_recorder
+        session.hooks['response'].append(get_recorder(record_directory).record)
+    session.hooks['response'].append(lambda r, *args, **kwargs: r.raise_for_status())
     return session
+
+
+class AsyncSession:
+    """
+    Asyncio counterpart of `new_session`; i.e. timeout, retries with back-off & `Retry-After`, error-raising.
+    The underlying aiohttp.ClientSession is created on first request, as it must belong to a running event loop.
+    """
+
+    def __init__(self, headers: Mapping[str, str] = None):
+        self.headers = dict(headers or {})
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _client(self):
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession(headers=self.headers,
+                                                  connector=aiohttp.TCPConnector(limit_per_host=DEFAULT_POOL_SIZE),
+                                                  timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+                                                  raise_for_status=False)
+        return self._session
+
+    async def request(self, method: str, url: str, **kwargs) -> Dict[str, Any]:
+        """ Returns decoded JSON response; retrying as per `new_session`'s retry strategy """
+        import asyncio
+
+        import aiohttp
+        is_idempotent = method.upper() in RETRY_METHODS
+        for attempt in range(DEFAULT_RETRIES + 1):
+            is_last = attempt == DEFAULT_RETRIES
+            try:
+                async with self._client().request(method, url, **kwargs) as response:
+                    is_retryable = is_idempotent or response.status == 429
+                    if response.status not in RETRY_STATUSES or not is_retryable or is_last:
+                        response.raise_for_status()
+                        return await response.json()
+                    delay = retry_after(response, default=backoff(attempt))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if is_last or not is_retryable_error(e, is_idempotent):
+                    raise
+                delay = backoff(attempt)
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, params: Mapping[str, Any] = None) -> Dict[str, Any]:
+        return await self.request('GET', url, params=params)
+
+    async def post(self, url: str, json: Any = None) -> Dict[str, Any]:
+        return await self.request('POST', url, json=json)
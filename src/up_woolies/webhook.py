@@ -0,0 +1,215 @@
+"""
+Real-time reconciliation driven by Up webhooks, rather than polling both APIs.
+
+The receiver verifies each event's `X-Up-Authenticity-Signature` & acknowledges it straight away. For each
+`TRANSACTION_CREATED` event it fetches that one Up transaction & keeps only Woolworths grocery purchases. It then finds
+the matching Woolies transaction in the head of the activity feed, fetches just its receipt & emits the itemised
+record. Register the receiver's public URL with Up's `/webhooks` endpoint, which returns the secret key.
+
+    $ UP_WEBHOOK_SECRET=... python webhook.py serve --port 8000
+    $ UP_WEBHOOK_SECRET=... python webhook.py send http://127.0.0.1:8000 <up transaction id>  # local stand-in sender
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import requests
+
+import up
+import woolies
+from export import Row, iter_rows
+from reconcile import MATCH_WINDOW, UP_CATEGORY, UP_DESCRIPTION, reconcile
+
+SIGNATURE_HEADER = 'X-Up-Authenticity-Signature'
+EVENT_TRANSACTION_CREATED = 'TRANSACTION_CREATED'
+DEFAULT_FEED_ATTEMPTS = 6
+DEFAULT_FEED_DELAY = 10  # seconds; the Woolies feed may lag behind the card payment
+DEFAULT_WORKERS = 4
+
+log = logging.getLogger(__name__)
+
+
+def sign(body: bytes, secret: str) -> str:
+    """ Returns hex HMAC-SHA256 signature of body, as per `X-Up-Authenticity-Signature` """
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify(body: bytes, signature: Optional[str], secret: str) -> bool:
+    return signature is not None and hmac.compare_digest(sign(body, secret), signature)
+
+
+def is_groceries(resource: Dict[str, Any]) -> bool:
+    """ Whether raw Up transaction is a Woolworths purchase; N.B. categories may be assigned after creation """
+    category = (resource['relationships'].get('category') or {}).get('data')
+    return (resource['attributes']['description'] == UP_DESCRIPTION
+            and (category is None or category['id'] == UP_CATEGORY))
+
+
+def find_woolies_transaction(up_transaction: up.Transaction,
+                             window: timedelta = MATCH_WINDOW,
+                             attempts: int = DEFAULT_FEED_ATTEMPTS,
+                             delay: float = DEFAULT_FEED_DELAY) -> Optional[woolies.Transaction]:
+    """
+    Returns Woolies transaction matching Up transaction, reading only the head of the activity feed around its date.
+    The feed is re-read up to `attempts` times, `delay` seconds apart, until the purchase shows up.
+    """
+    since, until = up_transaction.createdAt - window, up_transaction.createdAt + window
+    for attempt in range(attempts):
+        candidates = [transaction
+                      for transactions in woolies.Transaction.list_transactions(since=since, until=until)
+                      for transaction in transactions
+                      if transaction.partner == 'woolworths' and transaction.receiptId is not None]
+        if (reconciliation := reconcile(candidates, [up_transaction], window=window)).matched:
+            return reconciliation.matched[0][0]
+        if attempt < attempts - 1:
+            time.sleep(delay)
+    return None
+
+
+def emit_ndjson(rows: List[Row]):
+    """ Default sink; prints rows as NDJSON """
+    for row in rows:
+        print(json.dumps(row, default=str), flush=True)
+
+
+class WebhookReceiver(ThreadingHTTPServer):
+    """
+    Receives Up webhook events & reconciles Woolworths purchases in the background.
+
+    :param on_record: sink of the itemised rows of each reconciled purchase; as per `export.iter_rows`.
+    """
+    daemon_threads = True
+
+    def __init__(self,
+                 secret: str,
+                 address: Tuple[str, int] = ('127.0.0.1', 0),
+                 on_record: Callable[[List[Row]], None] = emit_ndjson,
+                 window: timedelta = MATCH_WINDOW,
+                 attempts: int = DEFAULT_FEED_ATTEMPTS,
+                 delay: float = DEFAULT_FEED_DELAY,
+                 max_workers: int = DEFAULT_WORKERS):
+        super().__init__(address, _WebhookHandler)
+        self.secret = secret
+        self.on_record = on_record
+        self.window = window
+        self.attempts = attempts
+        self.delay = delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='webhook')
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    def handle_event(self, event: Dict[str, Any]):
+        if event['data']['attributes']['eventType'] != EVENT_TRANSACTION_CREATED:
+            return  # e.g. PING, TRANSACTION_SETTLED
+        self.executor.submit(self._reconcile, event['data']['relationships']['transaction']['data']['id'])
+
+    def _reconcile(self, transaction_id: str):
+        try:
+            if (rows := self.reconcile(transaction_id)) is not None:
+                self.on_record(rows)
+        except Exception:
+            log.exception("failed to reconcile Up transaction %s", transaction_id)
+
+    def reconcile(self, transaction_id: str) -> Optional[List[Row]]:
+        """ Returns itemised rows of Up transaction's Woolworths purchase; or None if not one or not found """
+        if not is_groceries(resource := up.get_transaction(transaction_id)):
+            return None
+        up_transaction = up.Transaction.from_response(resource)
+        woolies_transaction = find_woolies_transaction(up_transaction, self.window, self.attempts, self.delay)
+        if woolies_transaction is None:
+            log.warning("couldn't find a Woolies transaction for Up transaction %s", transaction_id)
+            return None
+        return list(iter_rows([(woolies_transaction, up_transaction)]))
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server: WebhookReceiver
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not verify(body, self.headers.get(SIGNATURE_HEADER), self.server.secret):
+            self._send(401)
+            return
+        try:
+            self.server.handle_event(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            self._send(400)
+            return
+        self._send(200)  # acknowledge promptly; reconciliation continues in the background
+
+    def _send(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def event(transaction_id: str, event_type: str = EVENT_TRANSACTION_CREATED) -> Dict[str, Any]:
+    """ Returns webhook event resource, as sent by Up """
+    return {
+        'data': {
+            'type': 'webhook-events',
+            'id': str(uuid4()),
+            'attributes': {'eventType': event_type, 'createdAt': datetime.now(timezone.utc).isoformat()},
+            'relationships': {
+                'webhook': {'data': {'type': 'webhooks', 'id': str(uuid4())}},
+                'transaction': {'data': {'type': 'transactions', 'id': transaction_id}},
+            },
+        }
+    }
+
+
+def send_event(url: str, transaction_id: str, secret: str, event_type: str = EVENT_TRANSACTION_CREATED) -> int:
+    """ Signs & posts a webhook event to url, standing in for Up; returns the response status """
+    body = json.dumps(event(transaction_id, event_type)).encode()
+    response = requests.post(url, data=body, timeout=5, headers={
+        'Content-Type': 'application/json',
+        SIGNATURE_HEADER: sign(body, secret),
+    })
+    return response.status_code
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reconcile Woolworths purchases as Up webhook events arrive")
+    parser.add_argument('--secret', default=os.getenv('UP_WEBHOOK_SECRET'), help="default: $UP_WEBHOOK_SECRET")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="receive webhook events")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--attempts', type=int, default=DEFAULT_FEED_ATTEMPTS)
+    serve_parser.add_argument('--delay', type=float, default=DEFAULT_FEED_DELAY)
+    send_parser = subparsers.add_parser('send', help="send a signed event, standing in for Up")
+    send_parser.add_argument('url')
+    send_parser.add_argument('transaction_id')
+    send_parser.add_argument('--event-type', default=EVENT_TRANSACTION_CREATED)
+    args = parser.parse_args()
+    if args.secret is None:
+        parser.error("a webhook secret is required; pass --secret or set $UP_WEBHOOK_SECRET")
+
+    if args.command == 'send':
+        print(send_event(args.url, args.transaction_id, args.secret, event_type=args.event_type))
+    else:
+        receiver = WebhookReceiver(args.secret, (args.host, args.port), attempts=args.attempts, delay=args.delay)
+        print(f"receiving Up webhook events on {receiver.url}")
+        try:
+            receiver.serve_forever()
+        except KeyboardInterrupt:
+            receiver.server_close()
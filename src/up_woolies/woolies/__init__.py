@@ -1 +1,3 @@
-from .interfaces import PurchaseItem, ReceiptDetails, Transaction
+from .compact import CompactItem, CompactReceipt
+from .interfaces import (FIRST_PAGE_TOKEN, PurchaseItem, ReceiptDetails, Transaction, fetch_raw_receipts,
+                         fetch_receipts, iter_raw_receipts)
@@ -0,0 +1,103 @@
+"""
+Asyncio variant of the Woolies client surface; i.e. `Transaction.list_transactions` & `ReceiptDetails.get_receipt`.
+"""
+import asyncio
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Sequence
+from urllib.parse import urljoin
+
+from . import api
+from .interfaces import DEFAULT_RECEIPT_WORKERS, FIRST_PAGE_TOKEN, ReceiptDetails, Transaction, as_local_naive
+from utils import (DEFAULT_RETRIES, DEFAULT_TIMEOUT, RETRY_STATUSES, AsyncSession, backoff, is_retryable_error,
+                   retry_after)
+
+
+def new_async_session() -> AsyncSession:
+    """ Returns AsyncSession with Woolies client & authorisation headers """
+    return AsyncSession(headers=api.get_session().headers)
+
+
+def new_async_gql_client():
+    """
+    Returns gql.Client over aiohttp, with the same headers, retries & timeout as the synchronous client. Error statuses
+    raise aiohttp.ClientResponseError; rather than gql's errors, which lose the status of responses with a JSON body.
+    """
+    import gql
+    from gql.transport.aiohttp import AIOHTTPTransport
+
+    transport = AIOHTTPTransport(url=api.endpoint_graphql, headers=dict(api.get_session().headers),
+                                 client_session_args={'raise_for_status': True})
+    return gql.Client(transport=transport, execute_timeout=DEFAULT_TIMEOUT, serialize_variables=True)
+
+
+async def list_transactions(gql_client=None,
+                            since: datetime = None,
+                            until: datetime = None,
+                            fields: Sequence[str] = (),
+                            full: bool = False,
+                            keep_raw: bool = False) -> AsyncGenerator[List[Transaction], None]:
+    """ Yields page list of Transactions for Woolies account; see `Transaction.list_transactions` """
+    gql_client = gql_client or new_async_gql_client()
+    since, until = as_local_naive(since), as_local_naive(until)
+    query = api.get_fetch_transaction_query(tuple(fields), full=full)
+    async with gql_client as gql_session:
+        next_page_token = FIRST_PAGE_TOKEN
+        while True:
+            data = await _execute(gql_session, query, next_page_token)
+            if not data:
+                return
+            transactions, is_exhausted = Transaction.from_page(data, since=since, until=until, keep_raw=keep_raw)
+            yield transactions
+            if is_exhausted:
+                return
+            if (next_page_token := data['rtlRewardsActivityFeed']['list']['nextPageToken']) is None:
+                return
+
+
+async def _execute(gql_session, query, next_page_token: str) -> Dict[str, Any]:
+    # Mirror the synchronous client's retries on connection errors & retryable statuses; the feed query is idempotent
+    import aiohttp
+
+    for attempt in range(DEFAULT_RETRIES + 1):
+        is_last = attempt == DEFAULT_RETRIES
+        try:
+            return await gql_session.execute(query,
+                                             variable_values={'nextPageToken': next_page_token})
+        except aiohttp.ClientResponseError as e:
+            if is_last or e.status not in RETRY_STATUSES:
+                raise
+            delay = retry_after(e, default=backoff(attempt))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if is_last or not is_retryable_error(e, idempotent=True):
+                raise
+            delay = backoff(attempt)
+        await asyncio.sleep(delay)
+
+
+async def get_raw_receipt(session: AsyncSession, receipt_key: str) -> Dict[str, Any]:
+    """ Returns unparsed data response from receipt endpoint """
+    url = urljoin(api.endpoint, 'v1/rewards/member/ereceipts/transactions/details')
+    return (await session.post(url=url, json={"receiptKey": receipt_key}))['data']
+
+
+async def get_receipt(session: AsyncSession, receipt_key: str) -> ReceiptDetails:
+    return ReceiptDetails.from_raw(await get_raw_receipt(session, receipt_key))
+
+
+async def fetch_receipts(session: AsyncSession,
+                         transactions: Iterable[Transaction],
+                         max_workers: int = DEFAULT_RECEIPT_WORKERS) -> Dict[str, ReceiptDetails]:
+    """ Prefetches receipts concurrently & fills each transaction's receipt cache; see `fetch_receipts` """
+    semaphore = asyncio.Semaphore(max_workers)
+    pending = [transaction for transaction in transactions
+               if transaction.receiptId is not None and transaction.__dict__.get('_receipt') is None]
+    receipt_keys = list(dict.fromkeys(transaction.receiptId for transaction in pending))
+
+    async def fetch(receipt_key: str) -> ReceiptDetails:
+        async with semaphore:
+            return await get_receipt(session, receipt_key)
+
+    receipts = dict(zip(receipt_keys, await asyncio.gather(*map(fetch, receipt_keys))))
+    for transaction in pending:
+        transaction.set_receipt(receipts[transaction.receiptId])
+    return receipts
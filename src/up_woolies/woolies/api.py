@@ -1,31 +1,117 @@
 import os
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Tuple
 
-import gql
+import requests
 from dotenv import find_dotenv, load_dotenv
-from gql.transport.requests import RequestsHTTPTransport
 
-from utils import new_session
+from utils import DEFAULT_TIMEOUT, RETRY_METHODS, new_adapter, new_session
 
-# Get token from environment variables
-load_dotenv(dotenv_path=find_dotenv())
+# Define endpoints; overridable, e.g. to replay recorded responses
+endpoint = os.getenv('WOOLIES_ENDPOINT', "https://api.woolworthsrewards.com.au/wx/")
+endpoint_graphql = os.getenv('WOOLIES_GRAPHQL_ENDPOINT', "https://apigee-prod.api-wr.com/wx/v1/bff/graphql")
 
-# Define endpoint & headers
-endpoint = "https://api.woolworthsrewards.com.au/wx/"
-session = new_session()
-session.headers.update({
-    'client_id': '8h41mMOiDULmlLT28xKSv5ITpp3XBRvH',  # some universal client API ID key
-    'User-Agent': 'up_woolies'  # some User-Agent
-})
-session.headers.update({'Authorization': f"Bearer {os.environ['WOOLIES_TOKEN']}"})
 
-# Define GraphQL client
-_endpoint_graphql = "https://apigee-prod.api-wr.com/wx/v1/bff/graphql"
-_transport = RequestsHTTPTransport(url=_endpoint_graphql, verify=True, retries=3, headers=dict(session.headers))  # TODO
-gql_client = gql.Client(transport=_transport, execute_timeout=5, serialize_variables=True)
+@lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    """ Returns shared session with client & authorisation headers; created on first use """
+    # Get token from environment variables
+    load_dotenv(dotenv_path=find_dotenv())
 
-# The ugly GraphQL query that's baked-in to Woolies' JS client
-fetch_transaction_query = gql.gql(
+    session = new_session()
+    # The activity-feed query is idempotent, so its POSTs are retried like GETs; e.g. on a transient 5xx
+    session.mount(endpoint_graphql, new_adapter(methods=[*RETRY_METHODS, 'POST']))
+    session.headers.update({
+        'client_id': '8h41mMOiDULmlLT28xKSv5ITpp3XBRvH',  # some universal client API ID key
+        'User-Agent': 'up_woolies'  # some User-Agent
+    })
+    session.headers.update({'Authorization': f"Bearer {os.environ['WOOLIES_TOKEN']}"})
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_gql_client():
+    """ Returns shared GraphQL client over the shared session; i.e. its pooled connections, timeout & feed retries """
+    import gql
+    from gql.transport.requests import RequestsHTTPTransport
+
+    class SharedSessionTransport(RequestsHTTPTransport):
+        def connect(self):
+            self.session = get_session()
+
+        def close(self):
+            self.session = None  # the shared session, & its pool, outlive each execution
+
+    transport = SharedSessionTransport(url=endpoint_graphql, verify=True, timeout=DEFAULT_TIMEOUT)
+    return gql.Client(transport=transport, execute_timeout=DEFAULT_TIMEOUT, serialize_variables=True)
+
+
+@lru_cache(maxsize=None)
+def get_fetch_transaction_query(fields: Tuple[str, ...] = (), full: bool = False):
+    """ Returns parsed GraphQL query for the rewards activity feed; see `build_feed_query` """
+    import gql
+
+    return gql.gql(build_feed_query(fields, full=full))
+
+
+def build_feed_query(fields: Iterable[str] = (), full: bool = False) -> str:
+    """
+    Returns GraphQL query for the rewards activity feed, selecting only the item fields needed; i.e. less to send,
+    decode & keep per transaction than the full query.
+
+    :param fields: item fields to select alongside `FEED_FIELDS`; dotted for nested fields, e.g. 'highlights.value'.
+    :param full: select every field, as per Woolies' JS client.
     """
+    if full:
+        return FETCH_TRANSACTION_QUERY
+    selection: Dict[str, Any] = {}
+    for field in (*FEED_FIELDS, *fields):
+        node = selection
+        for name in field.split('.'):
+            node = node.setdefault(name, {})
+    return FEED_QUERY_TEMPLATE % _render_selection(selection, indent=' ' * 16)
+
+
+def _render_selection(selection: Dict[str, Any], indent: str) -> str:
+    return '\n'.join(f'{indent}{name} {{\n{_render_selection(nested, indent + "  ")}\n{indent}}}' if nested
+                     else f'{indent}{name}'
+                     for name, nested in selection.items())
+
+
+# Item fields read by `Transaction.from_response`; always selected
+FEED_FIELDS = (
+    'id',
+    'displayDate',
+    'description',
+    'displayValue',
+    'icon',
+    'iconUrl',
+    'transactionType',
+    'transaction.origin',
+    'transaction.amountAsDollars',
+    'receipt.receiptId',
+)
+
+FEED_QUERY_TEMPLATE = """
+    query RewardsActivityFeed($nextPageToken: String!) {
+      rtlRewardsActivityFeed(pageToken: $nextPageToken) {
+        list {
+          groups {
+            ... on RewardsActivityFeedGroup {
+              title
+              items {
+%s
+              }
+            }
+          }
+          nextPageToken
+        }
+      }
+    }
+"""
+
+# The ugly GraphQL query that's baked-in to Woolies' JS client
+FETCH_TRANSACTION_QUERY = """
     query RewardsActivityFeed($nextPageToken: String!) {
       rtlRewardsActivityFeed(pageToken: $nextPageToken) {
         list {
@@ -65,5 +151,4 @@ fetch_transaction_query = gql.gql(
         }
       }
     }
-    """
-)
+"""
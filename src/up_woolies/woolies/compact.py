@@ -0,0 +1,157 @@
+"""
+Fast-path receipt parsing into compact line-items; for analytics over thousands of receipts.
+
+Amounts are integer cents & weights integer grams, parsed in a single pass without pydantic validation or Decimal
+arithmetic. `CompactReceipt.view()` returns the equivalent `ReceiptDetails`, identical to `ReceiptDetails.from_raw`.
+"""
+import warnings
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from .interfaces import (PATTERN_CARD_PAYMENT, PATTERN_FOOTER_DATE, PATTERN_MULTIPLE, PATTERN_PRICE_REDUCED,
+                         PATTERN_WEIGHTED, PurchaseItem, ReceiptDetails)
+
+
+def parse_cents(money_str: str) -> int:
+    """ Returns integer cents of a money string with at most two decimal places; e.g. '-1.5' -> -150 """
+    is_negative = money_str.startswith('-')
+    dollars, _, cents = money_str.lstrip('-').partition('.')
+    if len(cents) > 2 or not (dollars + cents).isdigit():
+        raise ValueError(f"could not parse cents from {money_str!r}")
+    value = int(dollars or '0') * 100 + int(cents.ljust(2, '0'))
+    return -value if is_negative else value
+
+
+def parse_grams(kilograms_str: str) -> int:
+    """ Returns integer grams of a kilogram string with at most three decimal places; e.g. '0.716' -> 716 """
+    kilograms, _, grams = kilograms_str.partition('.')
+    if len(grams) > 3 or not (kilograms + grams).isdigit():
+        raise ValueError(f"could not parse grams from {kilograms_str!r}")
+    return int(kilograms or '0') * 1000 + int(grams.ljust(3, '0'))
+
+
+def _strip_money(money_str: str) -> str:
+    # As per `parse_money`; i.e. drop currency symbols & signs
+    return ''.join(c for c in money_str if c.isdigit() or c == '.')
+
+
+class CompactItem(NamedTuple):
+    """ Compact counterpart of `PurchaseItem` """
+    description: str
+    amount: int  # cents
+    quantity: Optional[int]
+    weight: Optional[int]  # grams
+
+    def view(self) -> PurchaseItem:
+        fields = dict(description=self.description,
+                      amount=Decimal(self.amount).scaleb(-2),
+                      quantity=self.quantity,
+                      weight=Decimal(self.weight).scaleb(-3) if self.weight is not None else None)
+        # Discounted amounts are not revalidated by `ReceiptDetails.from_raw`, so skip validation likewise
+        return PurchaseItem(**fields) if self.amount > 0 else PurchaseItem.construct(**fields)
+
+
+class CompactReceipt:
+    """ Compact counterpart of `ReceiptDetails` """
+    __slots__ = ('items', 'value', 'amount_paid', 'date')
+
+    def __init__(self, items: List[CompactItem], value: int, amount_paid: int, date: Optional[datetime]):
+        self.items = items
+        self.value = value  # cents
+        self.amount_paid = amount_paid  # cents
+        self.date = date
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(items={len(self.items)}, value={self.value}, "
+                f"amount_paid={self.amount_paid}, date={self.date!r})")
+
+    def view(self) -> ReceiptDetails:
+        """ Returns equivalent pydantic model; as per `ReceiptDetails.from_raw` """
+        return ReceiptDetails(items=[item.view() for item in self.items],
+                              value=Decimal(self.value).scaleb(-2),
+                              amount_paid=Decimal(self.amount_paid).scaleb(-2),
+                              date=self.date)
+
+    @classmethod
+    def from_raw(cls, response: Dict[str, Any]) -> 'CompactReceipt':
+        """
+        Returns compact receipt by parsing multi-line items from e-receipt response in a single pass; see
+        `ReceiptDetails.from_raw` for the multi-line patterns handled.
+        """
+        receipt_details_dict: Dict[str, Any] = {x['__typename']: x for x in response['receiptDetails']['details']}
+
+        # Parse transaction payment datetime
+        transaction_date = None
+        if (date_raw := PATTERN_FOOTER_DATE.search(
+                receipt_details_dict['ReceiptDetailsFooter']['transactionDetails'])) is not None:
+            transaction_date = datetime.strptime(date_raw.group(1), '%H:%M  %d/%m/%Y')
+
+        items: List[Dict[str, Any]] = receipt_details_dict['ReceiptDetailsItems']['items']
+        total_value = parse_cents(_strip_money(receipt_details_dict['ReceiptDetailsTotal']['total']))
+
+        # Find payment amount (may differ from owed amount if discounts are applied)
+        for payment in receipt_details_dict['ReceiptDetailsPayments']['payments']:
+            if PATTERN_CARD_PAYMENT.match(payment['description']):
+                amount_paid = parse_cents(_strip_money(payment['amount']))
+                break
+        else:
+            warnings.warn('unsupported payment method')
+            amount_paid = total_value  # stopgap for cash-purchases or other edge-cases
+
+        # Parse receipt items
+        purchases: List[CompactItem] = []
+        i, n_items = 0, len(items)
+        while i < n_items:
+            item = items[i]
+            description = item['description']
+
+            # Handle multi-line receipt item
+            if (amount := item['amount']) == '':
+                if i + 1 == n_items:
+                    if PATTERN_PRICE_REDUCED.match(description):
+                        break  # Safe to ignore
+                    raise ValueError("unforeseen edge case")
+                next_item = items[i + 1]
+
+                # Handle purchase of multiple identical items
+                if match := PATTERN_MULTIPLE.match(next_item_desc := next_item['description']):
+                    cents = _positive(parse_cents(next_item['amount']))
+                    purchase = CompactItem(description, cents, _positive(int(match.group(1))), None)
+                    i += 2
+
+                    # Amend for any discounts for multiple identical items purchased
+                    if i < n_items and (potential_discount_amount := items[i]['amount']):
+                        if (discount := parse_cents(potential_discount_amount)) < 0:
+                            purchase = purchase._replace(amount=cents + discount)
+                            i += 1
+
+                # Handle purchase of weighted item; e.g. fruit, veg, & deli
+                elif match := PATTERN_WEIGHTED.match(next_item_desc):
+                    purchase = CompactItem(description, _positive(parse_cents(next_item['amount'])), None,
+                                           _positive(parse_grams(match.group(1))))
+                    i += 2
+
+                # Ignore "price reduced" message in receipt
+                elif PATTERN_PRICE_REDUCED.match(description):
+                    i += 1
+                    continue
+                else:
+                    raise ValueError("unforeseen edge case")
+            elif (cents := parse_cents(amount)) < 0:
+                # Usually a discount
+                i += 1
+                continue
+            else:
+                purchase = CompactItem(description, _positive(cents), 1, None)
+                i += 1
+            purchases.append(purchase)
+
+        return cls(items=purchases, value=total_value, amount_paid=amount_paid, date=transaction_date)
+
+
+def _positive(value: int) -> int:
+    # As per `PurchaseItem` validation
+    if value <= 0:
+        raise ValueError(f"ensure this value is greater than 0; got {value}")
+    return value
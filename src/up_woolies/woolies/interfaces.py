@@ -1,16 +1,21 @@
+import json
 import os
 import re
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from decimal import Decimal
-from typing import Optional, List, Dict, Any, Literal, Generator
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Literal, Generator, Iterable, Sequence, Tuple
 from urllib.parse import urljoin
 
 from dateutil.relativedelta import relativedelta
 from pydantic import BaseModel, Extra, condecimal, PositiveInt
 
-from .api import session, endpoint, gql_client, fetch_transaction_query
-from utils import parse_money
+from . import api
+from archive import Archive
+from profiling import metrics
+from utils import TokenBucket, parse_money
 
 
 class PurchaseItem(BaseModel, extra=Extra.ignore):
@@ -30,6 +35,11 @@ PATTERN_MULTIPLE = re.compile(r'Qty (\d+) @ \$\d+\.\d+ each')  # e.g. 'Qty 2 @ $
 PATTERN_WEIGHTED = re.compile(r'(\d+\.\d+) kg NET @ \$\d+\.\d+/kg')  # e.g. '0.716 kg NET @ $4.00/kg'
 PATTERN_PRICE_REDUCED = re.compile(r'PRICE REDUCED BY \$\d+\.\d+(?: each|/kg)')  # e.g. PRICE REDUCED BY $3.15 each
 PATTERN_CARD_PAYMENT = re.compile(r'X-\d{4}|EFT')  # e.g. X-1234 or EFT
+PATTERN_FOOTER_DATE = re.compile(r'POS\s{2}\d{3}\s{2}TRANS\s{2}\d{4}\s{3}(.+)')  # e.g. 'POS  012  TRANS  ...'
+
+# Transaction-id regex patterns
+PATTERN_STORE_ID = re.compile(r'S\d{4}W\d{3}SN\d{4}T\d{10}')  # e.g. 'S3060W084SN2594T1667017441' store|...|date
+PATTERN_DATED_ID = re.compile(r'\d+')  # e.g. '20200804183836062051773127' date|time|...|storeno
 
 
 class ReceiptDetails(BaseModel):
@@ -45,10 +55,26 @@ class ReceiptDetails(BaseModel):
 
     @classmethod
     def get_receipt(cls, receipt_key: str):
-        url = urljoin(endpoint, 'v1/rewards/member/ereceipts/transactions/details')
+        return ReceiptDetails.from_raw(cls.get_raw_receipt(receipt_key))
+
+    @classmethod
+    def from_archive(cls, archive: Archive, receipt_key: str):
+        """ Returns receipt parsed from its archived data response; raises KeyError if not archived """
+        return cls.from_raw(archive.receipt(receipt_key))
+
+    @classmethod
+    def iter_archive(cls, archive: Archive) -> Generator[Tuple[str, 'ReceiptDetails'], None, None]:
+        """ Yields (receipt key, receipt) of each archived receipt in the order archived; streamed a block at a time """
+        for record in archive.scan('receipt'):
+            yield record['receiptKey'], cls.from_raw(record['data'])
+
+    @staticmethod
+    def get_raw_receipt(receipt_key: str) -> Dict[str, Any]:
+        """ Returns unparsed data response from receipt endpoint """
+        url = urljoin(api.endpoint, 'v1/rewards/member/ereceipts/transactions/details')
         body = {"receiptKey": receipt_key}
-        response = session.post(url=url, json=body)
-        return ReceiptDetails.from_raw(response.json()['data'])
+        response = api.get_session().post(url=url, json=body)
+        return response.json()['data']
 
     @classmethod
     def from_raw(cls, response: Dict[str, Any]):
@@ -63,8 +89,8 @@ class ReceiptDetails(BaseModel):
 
         # Parse transaction payment datetime
         transaction_date = None
-        if (date_raw := re.search('POS\s{2}\d{3}\s{2}TRANS\s{2}\d{4}\s{3}(.+)',
-                                  receipt_details_dict['ReceiptDetailsFooter']['transactionDetails'])) is not None:
+        if (date_raw := PATTERN_FOOTER_DATE.search(
+                receipt_details_dict['ReceiptDetailsFooter']['transactionDetails'])) is not None:
             transaction_date = datetime.strptime(date_raw.groups()[0], '%H:%M  %d/%m/%Y')
 
         # Navigate down to the response's receipt detail items & payment summaries
@@ -139,6 +165,47 @@ class ReceiptDetails(BaseModel):
 
 _two_months_ago = datetime.today() - relativedelta(months=2)
 
+FIRST_PAGE_TOKEN = "FIRST_PAGE"
+
+
+@lru_cache(maxsize=None)
+def _parse_partner(icon: str, icon_url: str) -> str:
+    # Attempt Woolworth's partner identification
+    if (partner := icon) == 'unknown_partner':
+        basename = os.path.basename(icon_url)
+        partner, *_ = basename.split('_logo.png')[0].split('_division')
+        if partner == 'supermarkets':
+            partner = 'woolworths'
+    return partner
+
+
+@lru_cache(maxsize=1024)
+def _parse_display_date(display_date: str, is_recent: bool) -> datetime:
+    # Display dates lack a year; i.e. 'Mon 01 Jan'. Those not of recent groups are assumed to be within the past year
+    transaction_date = datetime.strptime(display_date, '%a %d %b').replace(year=_two_months_ago.year)
+    if _two_months_ago < transaction_date and not is_recent:
+        transaction_date -= relativedelta(years=1)
+    return transaction_date
+
+
+def _parse_id_date(transaction_id: str, display_date: str, group_title: str) -> datetime:
+    # Get _rough_ transaction date
+    if PATTERN_STORE_ID.match(transaction_id):
+        return datetime.fromtimestamp(int(transaction_id[-10:]))
+    if PATTERN_DATED_ID.fullmatch(date_str := transaction_id[:20]):
+        if len(date_str) == 20:  # i.e. '%Y%m%d%H%M%S%f', without the cost of strptime
+            return datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8]), int(date_str[8:10]),
+                            int(date_str[10:12]), int(date_str[12:14]), int(date_str[14:]))
+        return datetime.strptime(date_str, '%Y%m%d%H%M%S%f')
+    return _parse_display_date(display_date, group_title in ['This Month', 'Last Month'])
+
+
+def as_local_naive(date: Optional[datetime]) -> Optional[datetime]:
+    """ Returns datetime as naive local-time for comparison with Woolies' transaction dates """
+    if date is None or date.tzinfo is None:
+        return date
+    return date.astimezone().replace(tzinfo=None)
+
 
 class Transaction(BaseModel, extra=Extra.allow):
     id: str
@@ -150,59 +217,141 @@ class Transaction(BaseModel, extra=Extra.allow):
     transactionType: str  # 'purchase' there could be others
     partner: Literal['woolworths', 'bws', 'bigw', 'eg', 'eg_ampol', 'caltex_woolworths']  # there could be others
     rewardsPointsEarned: str  # EveryDay Reward Points '+ 44 pts'
-    raw: Dict[str, Any]
+    raw: Optional[Dict[str, Any]]  # feed item as selected by the query; only kept if asked for
+
+    @staticmethod
+    def list_transactions(since: datetime = None,
+                          until: datetime = None,
+                          page_token: str = FIRST_PAGE_TOKEN,
+                          fields: Sequence[str] = (),
+                          full: bool = False,
+                          keep_raw: bool = False) -> Generator[List['Transaction'], None, None]:
+        """
+        Yields page list of Transactions for Woolies account, optionally bounded by date.
+
+        The activity feed is ordered newest first, so paging stops once the feed is older than `since`. Transactions
+        outside of the bounds are dropped from each page. N.B. naive datetimes are assumed local, as per `date`.
+
+        :param fields: extra feed-item fields to select; see `api.build_feed_query`.
+        :param full: select every feed-item field, as per Woolies' JS client.
+        :param keep_raw: keep each feed item as `raw`; otherwise dropped once parsed.
+        """
+        for transactions, _ in Transaction.list_pages(since=since, until=until, page_token=page_token,
+                                                      fields=fields, full=full, keep_raw=keep_raw):
+            yield transactions
 
     @staticmethod
-    def list_transactions() -> Generator[List['Transaction'], None, None]:
-        """ Yields page list of Transactions for Woolies account """
-        next_page_token = "FIRST_PAGE"
-        while True:
-            data = gql_client.execute(fetch_transaction_query, variable_values={'nextPageToken': next_page_token})
+    def list_pages(since: datetime = None,
+                   until: datetime = None,
+                   page_token: str = FIRST_PAGE_TOKEN,
+                   fields: Sequence[str] = (),
+                   full: bool = False,
+                   keep_raw: bool = False
+                   ) -> Generator[Tuple[List['Transaction'], Optional[str]], None, None]:
+        """
+        Yields page list of Transactions, as per `list_transactions`, with the token of the following page; or None
+        once paging is done. Paging starts from page_token, so that an interrupted walk can be resumed.
+        """
+        since, until = as_local_naive(since), as_local_naive(until)
+        for data in Transaction.list_raw_pages(page_token=page_token, fields=fields, full=full):
+            with metrics.stage('woolies from_response'):
+                transactions, is_exhausted = Transaction.from_page(data, since=since, until=until, keep_raw=keep_raw)
+            next_page_token = data['rtlRewardsActivityFeed']['list']['nextPageToken']
+            yield transactions, None if is_exhausted else next_page_token
+            if is_exhausted:
+                return
+
+    @staticmethod
+    def list_raw_pages(page_token: str = FIRST_PAGE_TOKEN,
+                       fields: Sequence[str] = (),
+                       full: bool = False) -> Generator[Dict[str, Any], None, None]:
+        """ Yields undecoded activity-feed pages from page_token until the end of the feed; close to stop early """
+        query = api.get_fetch_transaction_query(tuple(fields), full=full)
+        next_page_token = page_token
+        while next_page_token is not None:
+            with metrics.stage('woolies feed fetch'):
+                data = api.get_gql_client().execute(query,
+                                                    variable_values={'nextPageToken': next_page_token})
             if not data:
                 return
-            else:
-                yield [
-                    Transaction.from_response(data=item, group_title=months_transactions['title'])
-                    for months_transactions in data['rtlRewardsActivityFeed']['list']['groups']
-                    for item in months_transactions['items']
-                ]
-                if (next_page_token := data['rtlRewardsActivityFeed']['list']['nextPageToken']) is None:
-                    return
+            yield data
+            next_page_token = data['rtlRewardsActivityFeed']['list']['nextPageToken']
+
+    @classmethod
+    def from_page(cls,
+                  data: Dict[str, Any],
+                  since: datetime = None,
+                  until: datetime = None,
+                  keep_raw: bool = False,
+                  trusted: bool = False) -> Tuple[List['Transaction'], bool]:
+        """
+        Returns transactions within date bounds from an activity-feed page, & whether the feed is exhausted; i.e. the
+        page holds transactions older than `since`. N.B. bounds are expected as naive local-time.
+
+        :param trusted: skip validation; only for pages we've previously validated, e.g. from a recording.
+        """
+        construct = cls._construct if trusted else cls
+        transactions = [
+            construct(**cls._fields(item, months_transactions['title'], keep_raw))
+            for months_transactions in data['rtlRewardsActivityFeed']['list']['groups']
+            for item in months_transactions['items']
+        ]
+        is_exhausted = since is not None and any(transaction.date < since for transaction in transactions)
+        transactions = [transaction for transaction in transactions
+                        if (since is None or since <= transaction.date)
+                        and (until is None or transaction.date <= until)]
+        return transactions, is_exhausted
+
+    @classmethod
+    def from_response(cls, data: Dict[str, Any], group_title: str, keep_raw: bool = False):
+        return cls(**cls._fields(data, group_title, keep_raw))
+
+    @classmethod
+    def from_archive(cls, archive: Archive, transaction_id: str, keep_raw: bool = False):
+        """ Returns transaction from its archived feed item; raises KeyError if not archived """
+        return cls.from_response(*archive.feed_item(transaction_id), keep_raw=keep_raw)
+
+    @classmethod
+    def iter_archive(cls, archive: Archive, keep_raw: bool = False) -> Generator['Transaction', None, None]:
+        """ Yields every archived transaction in the order archived; streamed a block at a time """
+        for record in archive.scan('feed_item'):
+            yield cls.from_response(record['item'], record['title'], keep_raw=keep_raw)
+
+    @classmethod
+    def parse_rows(cls, rows: Iterable[str], trusted: bool = False) -> List['Transaction']:
+        """
+        Returns transactions from their JSON serialisations; e.g. rows of a local store.
+
+        :param trusted: skip validation; only for JSON serialised by `.json()` of already validated transactions.
+        """
+        if not trusted:
+            return [cls.parse_raw(row) for row in rows]
+        transactions = []
+        for row in rows:
+            fields = json.loads(row)
+            fields['date'] = datetime.fromisoformat(fields['date'])
+            transactions.append(cls._construct(**fields))
+        return transactions
 
     @classmethod
-    def from_response(cls, data: Dict[str, Any], group_title: str):
-
-        # Attempt Woolworth's partner identification
-        if (partner := data['icon']) == 'unknown_partner':
-            basename = os.path.basename(data['iconUrl'])
-            partner, *_ = basename.split('_logo.png')[0].split('_division')
-            if partner == 'supermarkets':
-                partner = 'woolworths'
-
-        # Get _rough_ transaction date
-        id_ = data['id']
-        if re.match(r'S\d{4}W\d{3}SN\d{4}T\d{10}', id_):  # 'S3060W084SN2594T1667017441' store|...|date
-            transaction_date = datetime.fromtimestamp(int(id_[-10:]))
-        elif re.match(r'^\d+$', date_str := id_[:20]):  # '20200804183836062051773127' date|time|...|storeno
-            transaction_date = datetime.strptime(date_str, '%Y%m%d%H%M%S%f')
-        else:
-            transaction_date = datetime.strptime(data['displayDate'], '%a %d %b')
-            transaction_date = transaction_date.replace(year=_two_months_ago.year)
-            if _two_months_ago < transaction_date and group_title not in ['This Month', 'Last Month']:
-                transaction_date -= relativedelta(years=1)
-
-        return cls(
-            id=data['id'],
-            date=transaction_date,
-            description=data['description'],
-            origin=data['transaction']['origin'],
-            value=data['transaction']['amountAsDollars'].replace('$', ''),
-            receiptId=data['receipt']['receiptId'] if data['receipt'] is not None else None,
-            partner=partner,
-            transactionType=data['transactionType'],
-            rewardsPointsEarned=data['displayValue'],
-            raw=data
-        )
+    def _construct(cls, **fields) -> 'Transaction':
+        # As per validation, but cheaper; i.e. for trusted input
+        return cls.construct(**{**fields, 'value': Decimal(str(fields['value']))})
+
+    @staticmethod
+    def _fields(data: Dict[str, Any], group_title: str, keep_raw: bool) -> Dict[str, Any]:
+        return {
+            'id': data['id'],
+            'date': _parse_id_date(data['id'], data['displayDate'], group_title),
+            'description': data['description'],
+            'origin': data['transaction']['origin'],
+            'value': data['transaction']['amountAsDollars'].replace('$', ''),
+            'receiptId': data['receipt']['receiptId'] if data['receipt'] is not None else None,
+            'partner': _parse_partner(data['icon'], data['iconUrl']),
+            'transactionType': data['transactionType'],
+            'rewardsPointsEarned': data['displayValue'],
+            'raw': data if keep_raw else None,
+        }
 
     def amount_paid(self) -> Decimal:
         """ Amount paid; may vary from cost of items due to gift-cards/discounts at checkout """
@@ -215,6 +364,14 @@ class Transaction(BaseModel, extra=Extra.allow):
             self.__dict__['_receipt'] = _receipt
         return _receipt
 
+    def set_receipt(self, receipt: ReceiptDetails):
+        """ Fills lazy-loaded receipt cache; e.g. from a batch fetch """
+        self.__dict__['_receipt'] = receipt
+
+    def release_receipt(self):
+        """ Drops cached receipt; e.g. once processed in a stream """
+        self.__dict__.pop('_receipt', None)
+
     @property
     def has_receipt(self) -> bool:
         return self.receipt is not None
@@ -224,8 +381,67 @@ class Transaction(BaseModel, extra=Extra.allow):
         return self.origin
 
 
+DEFAULT_RECEIPT_WORKERS = 8  # N.B. kept below the session's connection-pool size
+DEFAULT_RECEIPT_RATE = 10  # receipts per second
+
+
+def fetch_raw_receipts(receipt_keys: Iterable[str],
+                       max_workers: int = DEFAULT_RECEIPT_WORKERS,
+                       rate: float = DEFAULT_RECEIPT_RATE) -> Dict[str, Dict[str, Any]]:
+    """
+    Returns unparsed receipts by receipt key, requested concurrently over the shared session.
+
+    Requests are limited by a token-bucket to `rate` per second. Rate-limited requests, i.e. 429, are retried by the
+    session after the `Retry-After` period, which also pauses the host's other requests; see `HostController`.
+    """
+    receipt_keys = list(dict.fromkeys(receipt_keys))  # de-duplicate but keep order
+    raw_receipts = dict(iter_raw_receipts(receipt_keys, max_workers, rate))
+    return {receipt_key: raw_receipts[receipt_key] for receipt_key in receipt_keys}
+
+
+def iter_raw_receipts(receipt_keys: Iterable[str],
+                      max_workers: int = DEFAULT_RECEIPT_WORKERS,
+                      rate: float = DEFAULT_RECEIPT_RATE) -> Generator[Tuple[str, Dict[str, Any]], None, None]:
+    """
+    Yields (receipt key, unparsed receipt) as each is fetched, as per `fetch_raw_receipts`; so that callers can keep
+    each receipt before the next arrives, e.g. to resume after an expired token.
+    """
+    limiter = TokenBucket(rate=rate)
+
+    def fetch(receipt_key: str) -> Dict[str, Any]:
+        limiter.acquire()
+        return ReceiptDetails.get_raw_receipt(receipt_key)
+
+    receipt_keys = list(dict.fromkeys(receipt_keys))  # de-duplicate but keep order
+    with metrics.stage('woolies receipt fetch'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, receipt_key): receipt_key for receipt_key in receipt_keys}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def fetch_receipts(transactions: Iterable[Transaction],
+                   max_workers: int = DEFAULT_RECEIPT_WORKERS,
+                   rate: float = DEFAULT_RECEIPT_RATE) -> Dict[str, ReceiptDetails]:
+    """
+    Prefetches receipts for many transactions concurrently & fills each transaction's receipt cache, so that later
+    calls to `Transaction.receipt()` are free. Transactions without e-receipts or already cached are skipped.
+    """
+    pending = [transaction for transaction in transactions
+               if transaction.receiptId is not None and transaction.__dict__.get('_receipt') is None]
+    raw_receipts = fetch_raw_receipts((transaction.receiptId for transaction in pending), max_workers, rate)
+    with metrics.stage('woolies from_raw'):
+        receipts = {receipt_key: ReceiptDetails.from_raw(raw) for receipt_key, raw in raw_receipts.items()}
+    for transaction in pending:
+        transaction.set_receipt(receipts[transaction.receiptId])
+    return receipts
+
+
 if __name__ == '__main__':
-    transactions: List[Transaction] = [y for x in Transaction.list_transactions() for y in x]
-    for trans in transactions:
-        if not trans.has_receipt:  # Ignore partners w/o receipt data
-            print(trans.id, trans.date, trans.value, trans.json())
+    for transactions in Transaction.list_transactions():  # stream page by page, rather than holding the whole feed
+        for trans in transactions:
+            if not trans.has_receipt:  # Ignore partners w/o receipt data
+                print(trans.id, trans.date, trans.value, trans.json())